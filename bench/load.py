@@ -0,0 +1,257 @@
+"""
+Drives every router of a running API at a fixed concurrency, one scenario after another, and prints latency
+percentiles and throughput per scenario as JSON. Expects data from bench.seed (users user1..userN with the
+same password) and an S3 stand-in behind the API, see docker-compose.bench.yml.
+
+    python -m bench.load --url http://localhost --concurrency 32 --duration 30 > run.json
+    python -m bench.load --scenarios posts.latests,posts.recommended
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+import aiohttp
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class VirtualUser:
+    def __init__(self, http: aiohttp.ClientSession, url: str, id: int, token: str, max_post_id: int):
+        self.http = http
+        self.url = url
+        self.id = id
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.max_post_id = max_post_id
+        self.cursor = None
+        self.liked = set()
+        self.images = []
+
+    def post_id(self) -> int:
+        return random.randint(1, self.max_post_id)
+
+    async def request(self, method: str, path: str, **kwargs) -> int:
+        async with self.http.request(method, self.url + path, headers=self.headers, allow_redirects=False,
+                                     **kwargs) as response:
+            await response.read()
+            return response.status
+
+    async def get_json(self, path: str) -> dict:
+        async with self.http.get(self.url + path, headers=self.headers) as response:
+            return await response.json()
+
+
+def jpeg() -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (1280, 720), 'teal').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+JPEG = None
+
+
+def unique_jpeg() -> bytes:
+    # bytes after the end of image make a new content hash, so every upload goes to S3
+    global JPEG
+    if JPEG is None:
+        JPEG = jpeg()
+    return JPEG + os.urandom(16)
+
+
+async def auth_login(user: VirtualUser, args):
+    return await user.request('POST', '/login', json={'login': f'user{user.id}', 'password': args.password})
+
+
+async def auth_register(user: VirtualUser, args):
+    login = f'bench-{uuid.uuid4().hex}'
+    return await user.request('POST', '/register', json={'login': login, 'name': login, 'password': args.password})
+
+
+async def users_me(user: VirtualUser, args):
+    return await user.request('GET', '/user/me')
+
+
+async def users_get(user: VirtualUser, args):
+    return await user.request('GET', f'/user/{random.randint(1, args.users)}')
+
+
+async def users_edit(user: VirtualUser, args):
+    return await user.request('POST', '/user/edit', json={'name': f'Пользователь {user.id}',
+                                                          'about': uuid.uuid4().hex, 'img_hash': None})
+
+
+async def posts_latests(user: VirtualUser, args):
+    return await user.request('GET', f'/post/latests?per_page={args.per_page}')
+
+
+async def posts_latests_scroll(user: VirtualUser, args):
+    """
+    Follows next_cursor page after page, starting over at the end of the feed
+    """
+    path = f'/post/latests?per_page={args.per_page}&count=none'
+    page = await user.get_json(path + (f'&cursor={user.cursor}' if user.cursor else ''))
+    user.cursor = page.get('next_cursor')
+    return 200 if 'items' in page else 500
+
+
+async def posts_recommended(user: VirtualUser, args):
+    return await user.request('GET', f'/post/recommended?per_page={args.per_page}')
+
+
+async def posts_user(user: VirtualUser, args):
+    return await user.request('GET', f'/post/user/{random.randint(1, args.users)}?per_page={args.per_page}')
+
+
+async def posts_get(user: VirtualUser, args):
+    return await user.request('GET', f'/post/{user.post_id()}')
+
+
+async def posts_comments(user: VirtualUser, args):
+    return await user.request('GET', f'/post/{user.post_id()}/comments?per_page={args.per_page}')
+
+
+async def posts_detail(user: VirtualUser, args):
+    return await user.request('GET', f'/post/{user.post_id()}/detail')
+
+
+async def posts_add(user: VirtualUser, args):
+    images = user.images[-1:]
+    return await user.request('POST', '/post/add', json={'title': 'Бенчмарк', 'text': uuid.uuid4().hex,
+                                                         'images': images})
+
+
+async def posts_like(user: VirtualUser, args):
+    post_id = user.post_id()
+    if post_id in user.liked:
+        user.liked.discard(post_id)
+        return await user.request('DELETE', f'/post/{post_id}/like')
+    user.liked.add(post_id)
+    return await user.request('POST', f'/post/{post_id}/like')
+
+
+async def posts_comment(user: VirtualUser, args):
+    return await user.request('POST', f'/post/{user.post_id()}/comment', json={'text': uuid.uuid4().hex})
+
+
+async def images_upload(user: VirtualUser, args):
+    form = aiohttp.FormData()
+    form.add_field('file', unique_jpeg(), filename='bench.jpg', content_type='image/jpeg')
+    async with user.http.post(user.url + '/image/upload', data=form, headers=user.headers) as response:
+        body = await response.json()
+        if response.status == 200:
+            user.images.append(body['hash'])
+        return response.status
+
+
+async def images_get(user: VirtualUser, args):
+    return await user.request('GET', f'/image/seed-{random.randint(1, args.images):09d}.jpg')
+
+
+SCENARIOS = {
+    'auth.login': auth_login,
+    'auth.register': auth_register,
+    'users.me': users_me,
+    'users.get': users_get,
+    'users.edit': users_edit,
+    'posts.latests': posts_latests,
+    'posts.latests_scroll': posts_latests_scroll,
+    'posts.recommended': posts_recommended,
+    'posts.user': posts_user,
+    'posts.get': posts_get,
+    'posts.comments': posts_comments,
+    'posts.detail': posts_detail,
+    'posts.like': posts_like,
+    'posts.comment': posts_comment,
+    'images.upload': images_upload,
+    'posts.add': posts_add,
+    'images.get': images_get,
+}
+
+
+async def run_scenario(users: list[VirtualUser], scenario, args) -> dict:
+    latencies, errors, statuses = [], 0, {}
+    deadline = time.perf_counter() + args.duration
+
+    async def worker(user):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status = await scenario(user, args)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                status = 'error'
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 'error' or status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(user) for user in users))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': statuses,
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(statistics.median(latencies) * 1000, 2),
+            'p95': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            'max': round(max(latencies) * 1000, 2),
+        } if latencies else None,
+    }
+
+
+async def login(http: aiohttp.ClientSession, url: str, id: int, password: str) -> str:
+    async with http.post(url + '/login', json={'login': f'user{id}', 'password': password}) as response:
+        response.raise_for_status()
+        return (await response.json())['access_token']
+
+
+async def main(args):
+    names = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+        ids = random.Random(args.seed).sample(range(1, args.users + 1), args.concurrency)
+        tokens = await asyncio.gather(*(login(http, args.url, id, args.password) for id in ids))
+        probe = VirtualUser(http, args.url, ids[0], tokens[0], 1)
+        latest = await probe.get_json('/post/latests?per_page=1&count=none')
+        max_post_id = latest['items'][0]['id'] if latest['items'] else 1
+        users = [VirtualUser(http, args.url, id, token, max_post_id) for id, token in zip(ids, tokens)]
+
+        result = {'url': args.url, 'concurrency': args.concurrency, 'duration': args.duration,
+                  'per_page': args.per_page, 'scenarios': {}}
+        for name in names:
+            result['scenarios'][name] = await run_scenario(users, SCENARIOS[name], args)
+            print(f"{name}: {result['scenarios'][name]['requests_per_second']} rps", file=sys.stderr)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--scenarios", help="comma separated, all by default: " + ', '.join(SCENARIOS))
+    parser.add_argument("--users", type=int, default=10_000, help="users created by bench.seed")
+    parser.add_argument("--images", type=int, default=1_000, help="images created by bench.seed to request")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--per-page", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
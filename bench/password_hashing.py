@@ -0,0 +1,75 @@
+"""
+Event loop latency while bcrypt runs for concurrent logins: inline (as the handlers did before) vs hash_pool.
+
+    python -m bench.password_hashing --logins 64 --rounds 12
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+for name in ("DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME", "S3_URL", "S3_BUCKET", "S3_ACCESS_KEY",
+             "S3_SECRET_KEY", "JWT_SECRET_KEY"):
+    os.environ.setdefault(name, "bench")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def measure(logins: int, verify, tick: float = 0.005) -> dict:
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(tick)
+            lags.append(time.perf_counter() - start - tick)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(verify() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker_task
+    return {
+        "logins_per_second": round(logins / elapsed, 1),
+        "loop_lag_ms": {
+            "p50": round(statistics.median(lags) * 1000, 2),
+            "p99": round(percentile(lags, 0.99) * 1000, 2),
+            "max": round(max(lags) * 1000, 2),
+        },
+    }
+
+
+async def main(args):
+    os.environ["BCRYPT_ROUNDS"] = str(args.rounds)
+    os.environ["PASSWORD_HASH_MAX_QUEUE"] = str(args.logins)
+    from src.api.routers.auth import utils
+
+    hashed = utils.pwd_context.hash("password")
+
+    async def inline():
+        utils.pwd_context.verify("password", hashed)
+
+    async def pooled():
+        await utils.verify_password("password", hashed)
+
+    print(json.dumps({
+        "logins": args.logins,
+        "rounds": args.rounds,
+        "workers": utils.hash_pool._max_workers,
+        "inline": await measure(args.logins, inline),
+        "pool": await measure(args.logins, pooled),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=12)
+    asyncio.run(main(parser.parse_args()))
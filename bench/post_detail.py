@@ -0,0 +1,83 @@
+"""
+Post page of a client: /post/{id}/detail (crud.get_post_detail, one statement building the JSON in Postgres)
+against the two calls it replaces, get_post_by_id and the first page of get_comments, with the SQL statements
+each way runs. Posts are random ones, on data from bench.seed.
+
+    python -m bench.post_detail --posts 200 --comments 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import event, select
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def measure(run, ids: list[int], statements: list[int]) -> dict:
+    latencies, counts = [], []
+    for id in ids:
+        before = statements[0]
+        start = time.perf_counter()
+        await run(id)
+        latencies.append(time.perf_counter() - start)
+        counts.append(statements[0] - before)
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'statements': round(statistics.mean(counts), 1),
+    }
+
+
+async def main(args):
+    from src.api.routers.posts.models import PostResponse, CommentListResponse, post_detail_response
+    from src.api.sessions import async_session, engine
+    from src.db import crud
+    from src.db.schemas import Post
+    from src.db.utils import CountMode
+
+    statements = [0]
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def count(*_):
+        statements[0] += 1
+
+    rng = random.Random(args.seed)
+    async with async_session() as session:
+        max_id = await session.scalar(select(Post.id).order_by(Post.id.desc()).limit(1))
+        ids = [rng.randint(1, max_id) for _ in range(args.posts)]
+
+        async def two_calls(id):
+            # as the endpoints do it, each response validated by its pydantic model
+            post = await crud.get_post_by_id(session, id, args.user_id)
+            comments = await crud.get_comments(session, id, args.comments, 0, count_mode=CountMode.estimated)
+            PostResponse.model_validate(post, from_attributes=True)
+            CommentListResponse.model_validate(comments, from_attributes=True)
+            session.expunge_all()
+
+        async def detail(id):
+            post_detail_response(await crud.get_post_detail(session, id, args.user_id, args.comments))
+
+        # one untimed round each, so both start with the same pages cached
+        await measure(two_calls, ids[:10], statements)
+        await measure(detail, ids[:10], statements)
+        result = {'posts': args.posts, 'comments': args.comments,
+                  'two_calls': await measure(two_calls, ids, statements),
+                  'detail': await measure(detail, ids, statements)}
+    await engine.dispose()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--comments", type=int, default=20, help="comments on the first page")
+    parser.add_argument("--user-id", type=int, default=1, help="reader, for is_liked")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,71 @@
+"""
+Time to turn a page of posts into the response body: response_model validation with JSONResponse (as the
+list endpoints did before) vs posts_list_response with ORJSONResponse. Checks that both bodies are equal.
+
+    python -m bench.post_list_serialization --per-page 100 --images 2
+"""
+import argparse
+import json
+import os
+import timeit
+from types import SimpleNamespace
+
+for name in ("DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME", "S3_BUCKET", "S3_ACCESS_KEY",
+             "S3_SECRET_KEY", "JWT_SECRET_KEY"):
+    os.environ.setdefault(name, "bench")
+os.environ.setdefault("S3_URL", "http://localhost:9000")
+
+
+def make_page(per_page: int, images: int, orm: bool) -> dict:
+    def image(i):
+        return SimpleNamespace(hash=f'{i:064x}.jpg', width=1300, height=700,
+                               variant_widths=[160, 480, 1080] if i % 2 else None)
+
+    posts = []
+    for i in range(per_page):
+        user = SimpleNamespace(id=i % 7, name=f'Пользователь {i % 7}', about='about "me"\n' if i % 3 else None,
+                               images=[image(i)])
+        posts.append(SimpleNamespace(id=i, title=f'Post {i}', text='Текст поста ' * 20,
+                                     images=[image(i * 10 + j) for j in range(images)], user=user,
+                                     like_count=i * 3, comment_count=i, is_liked=bool(i % 2)))
+    if not orm:
+        from src.db.utils import post_to_dict
+
+        posts = [{**post_to_dict(post), 'is_liked': post.is_liked} for post in posts]
+    return {'count': per_page * 10, 'items': posts, 'has_more': True, 'next_cursor': 'WyIyMDI0Il0'}
+
+
+def main(args):
+    from fastapi.responses import JSONResponse, ORJSONResponse
+
+    from src.api.routers.posts.models import PostsListResponse, posts_list_response
+
+    def pydantic_body(page):
+        model = PostsListResponse.model_validate(page, from_attributes=True)
+        return JSONResponse(model.model_dump(mode='json')).body
+
+    def fast_body(page):
+        return ORJSONResponse(posts_list_response(page)).body
+
+    result = {"per_page": args.per_page, "images_per_post": args.images}
+    for name, orm in (("orm_objects", True), ("cached_dicts", False)):
+        page = make_page(args.per_page, args.images, orm)
+        before, after = pydantic_body(page), fast_body(page)
+        timings = {}
+        for label, render in (("pydantic_json", pydantic_body), ("plain_orjson", fast_body)):
+            best = min(timeit.repeat(lambda: render(page), number=args.number, repeat=5)) / args.number
+            timings[label] = round(best * 1000, 3)
+        result[name] = {
+            "identical": before == after,
+            "ms_per_page": timings,
+            "speedup": round(timings["pydantic_json"] / timings["plain_orjson"], 1),
+        }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--per-page", type=int, default=100)
+    parser.add_argument("--images", type=int, default=2)
+    parser.add_argument("--number", type=int, default=20)
+    main(parser.parse_args())
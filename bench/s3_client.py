@@ -0,0 +1,97 @@
+"""
+Per-request overhead of S3 calls: a new session and client for every request (as get_image and
+upload_frames did before) vs the application-lifetime client. Needs an S3 compatible server, e.g. MinIO
+or `moto_server -p 9000`:
+
+    S3_URL=http://127.0.0.1:9000 S3_BUCKET=images S3_ACCESS_KEY=a S3_SECRET_KEY=b \
+        python -m bench.s3_client --requests 200 --concurrency 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+for name in ("DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME", "S3_URL", "S3_BUCKET", "S3_ACCESS_KEY",
+             "S3_SECRET_KEY", "JWT_SECRET_KEY"):
+    os.environ.setdefault(name, "bench")
+
+KEY = 'bench-s3-client'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def measure(requests: int, concurrency: int, request) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed():
+        async with semaphore:
+            start = time.perf_counter()
+            await request()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests_per_second": round(requests / elapsed, 1),
+        "latency_ms": {
+            "p50": round(statistics.median(latencies) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+        },
+    }
+
+
+async def main(args):
+    from aioboto3 import Session
+    from botocore.config import Config
+
+    from src import config
+    from src.api.sessions import s3_client
+
+    def new_client():
+        return Session().client('s3', endpoint_url=config.S3_URL, aws_access_key_id=config.S3_ACCESS_KEY,
+                                aws_secret_access_key=config.S3_SECRET_KEY, config=Config(signature_version='s3v4'))
+
+    async def per_request_head():
+        async with new_client() as s3:
+            await s3.head_object(Bucket=config.S3_BUCKET, Key=KEY)
+
+    async def per_request_presign():
+        async with new_client() as s3:
+            await s3.generate_presigned_url('get_object', Params={'Bucket': config.S3_BUCKET, 'Key': KEY},
+                                            ExpiresIn=3600)
+
+    async def shared_head():
+        await s3_client.client.head_object(Bucket=config.S3_BUCKET, Key=KEY)
+
+    async def shared_presign():
+        await s3_client.client.generate_presigned_url('get_object', Params={'Bucket': config.S3_BUCKET, 'Key': KEY},
+                                                      ExpiresIn=3600)
+
+    await s3_client.start()
+    try:
+        await s3_client.client.put_object(Bucket=config.S3_BUCKET, Key=KEY, Body=b'bench')
+        result = {"requests": args.requests, "concurrency": args.concurrency}
+        for name, per_request, shared in (("head_object", per_request_head, shared_head),
+                                          ("presign", per_request_presign, shared_presign)):
+            result[name] = {
+                "client_per_request": await measure(args.requests, args.concurrency, per_request),
+                "shared_client": await measure(args.requests, args.concurrency, shared),
+            }
+        await s3_client.client.delete_object(Bucket=config.S3_BUCKET, Key=KEY)
+    finally:
+        await s3_client.stop()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,90 @@
+"""
+First page of /post/search (crud.search_posts over the search_vector GIN indexes) against the ILIKE scan it
+replaces, newest first, on data from bench.seed. Queries are a common word, two common words and one of the
+rare tag words of bench.seed.
+
+    python -m bench.search --queries 50 --per-page 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import and_, exists, or_, select
+
+from bench.seed import WORDS
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def ilike_posts(words: list[str], limit: int, user_id: int):
+    from src.db.schemas import Comment, Post
+    from src.db.utils import post_options
+
+    def matches(word):
+        pattern = f'%{word}%'
+        return or_(Post.title.ilike(pattern), Post.text.ilike(pattern),
+                   exists().where(Comment.post_id == Post.id, Comment.is_deleted == 0, Comment.text.ilike(pattern)))
+
+    return (select(Post).options(*post_options(user_id))
+            .where(Post.is_deleted == 0, and_(*(matches(word) for word in words)))
+            .order_by(Post.created_time.desc(), Post.id.desc()).limit(limit))
+
+
+async def measure(run, queries: list[str]) -> dict:
+    latencies, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found.append(await run(query))
+        latencies.append(time.perf_counter() - start)
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'avg_items': round(statistics.mean(found), 1),
+    }
+
+
+async def main(args):
+    from src.api.sessions import async_session, engine
+    from src.db import crud
+    from src.db.utils import CountMode
+
+    rng = random.Random(args.seed)
+    kinds = {
+        'common word': [rng.choice(WORDS) for _ in range(args.queries)],
+        'two common words': [' '.join(rng.sample(WORDS, 2)) for _ in range(args.queries)],
+        'rare word': [f'тег{rng.randrange(args.tags)}' for _ in range(args.queries)],
+    }
+
+    async with async_session() as session:
+        async def search(query):
+            res = await crud.search_posts(session, query, args.per_page, args.user_id, count_mode=CountMode.none)
+            return len(res['items'])
+
+        async def ilike(query):
+            return len((await session.scalars(ilike_posts(query.split(), args.per_page, args.user_id))).all())
+
+        result = {'per_page': args.per_page, 'queries': args.queries, 'kinds': {}}
+        for kind, queries in kinds.items():
+            # one untimed round each, so both start with the same pages cached
+            await measure(search, queries[:3])
+            await measure(ilike, queries[:3])
+            result['kinds'][kind] = {'search': await measure(search, queries),
+                                     'ilike': await measure(ilike, queries)}
+    await engine.dispose()
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=50, help="per kind of query")
+    parser.add_argument("--per-page", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=10_000, help="--tags of bench.seed")
+    parser.add_argument("--user-id", type=int, default=1, help="reader, for is_liked")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
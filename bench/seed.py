@@ -0,0 +1,176 @@
+"""
+Fills an empty database with generated users, images, posts, likes and comments through COPY. Posts are
+spread over --days, likes and comments per post follow a long tailed distribution, counters and scores of
+posts match the generated rows. Every user logs in as user<id> with --password.
+
+    python -m bench.seed --users 1000000 --posts 10000000 --likes 100000000 --comments 20000000
+
+Images are only rows, use --upload to also put small JPEGs under their keys in S3.
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import random
+import time
+
+from sqlalchemy import text
+
+CHUNK = 10_000
+WORDS = ('итмо', 'лекция', 'сессия', 'общежитие', 'кофе', 'проект', 'дедлайн', 'матан', 'питон', 'кронверкский',
+         'столовая', 'экзамен', 'лаба', 'коворкинг', 'олимпиада', 'хакатон', 'семинар', 'зачёт', 'бот', 'стипендия')
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def long_tail(rng: random.Random, mean: float, limit: int) -> int:
+    # pareto with alpha 2 has mean 2
+    return min(limit, int(rng.paretovariate(2) * mean / 2))
+
+
+class Seeder:
+    def __init__(self, conn, args):
+        self.conn = conn
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.now = datetime.datetime.now()
+        self.counts = {'user': 0, 'image': 0, 'user_image': 0, 'post': 0, 'post_image': 0, 'like': 0, 'comment': 0}
+
+    async def copy(self, table: str, columns: list[str], records: list[tuple]):
+        if records:
+            await self.conn.copy_records_to_table(table, records=records, columns=columns)
+            self.counts[table] += len(records)
+
+    def image(self, id: int, user_id: int) -> tuple:
+        width, height = self.rng.choice(((1080, 1080), (1280, 720), (720, 1280), (1600, 1200)))
+        # referenced once, so never orphaned: the column defaults to now() for new uploads
+        return id, f'seed-{id:09d}.jpg', width, height, 1, None, user_id
+
+    async def users(self, password: str):
+        from src.api.routers.auth.utils import pwd_context
+
+        hashed = pwd_context.hash(password)
+        image_id = 0
+        for start in range(1, self.args.users + 1, CHUNK):
+            users, images, links = [], [], []
+            for id in range(start, min(start + CHUNK, self.args.users + 1)):
+                created = self.now - datetime.timedelta(seconds=self.rng.randrange(self.args.days * 86400))
+                about = sentence(self.rng, 8) if self.rng.random() < 0.5 else None
+                users.append((id, f'user{id}', hashed, f'Пользователь {id}', about, created, created, 0))
+                if self.rng.random() < self.args.avatar_share:
+                    image_id += 1
+                    images.append(self.image(image_id, id))
+                    links.append((id, image_id))
+            await self.copy('user', ['id', 'login', 'password', 'name', 'about', 'created_time', 'modified_time',
+                                     'is_deleted'], users)
+            await self.copy('image', ['id', 'hash', 'width', 'height', 'ref_count', 'orphaned_time',
+                                      'created_by'], images)
+            await self.copy('user_image', ['user_id', 'image_id'], links)
+        return image_id
+
+    async def posts(self, image_id: int):
+        from src import config
+
+        args = self.args
+        likes_per_post = args.likes / max(args.posts, 1)
+        comments_per_post = args.comments / max(args.posts, 1)
+        comment_id = 0
+        for start in range(1, args.posts + 1, CHUNK):
+            posts, images, links, likes, comments = [], [], [], [], []
+            for id in range(start, min(start + CHUNK, args.posts + 1)):
+                user_id = self.rng.randint(1, args.users)
+                created = self.now - datetime.timedelta(seconds=self.rng.randrange(args.days * 86400))
+                liked_by = self.rng.sample(range(1, args.users + 1), long_tail(self.rng, likes_per_post, args.users))
+                comment_count = long_tail(self.rng, comments_per_post, 10 * args.users)
+                # extract(epoch) of post_score reads the naive created_time as utc, timestamp() would take it as local
+                score = (config.POST_SCORE_C * len(liked_by) + config.POST_SCORE_X * comment_count
+                         + config.POST_SCORE_F * created.replace(tzinfo=datetime.timezone.utc).timestamp())
+                # one of --tags rare words per post, something for bench.search to find among few posts
+                text = f'{sentence(self.rng, 30)} тег{self.rng.randrange(args.tags)}'
+                posts.append((id, sentence(self.rng, 4), text, created, created, 0, user_id, len(liked_by),
+                              comment_count, score))
+                if self.rng.random() < args.image_share:
+                    image_id += 1
+                    images.append(self.image(image_id, user_id))
+                    links.append((id, image_id))
+                likes.extend((id, liker) for liker in liked_by)
+                for _ in range(comment_count):
+                    comment_id += 1
+                    comments.append((comment_id, sentence(self.rng, 10), id, self.rng.randint(1, args.users),
+                                     created, created, 0))
+            await self.copy('image', ['id', 'hash', 'width', 'height', 'ref_count', 'orphaned_time',
+                                      'created_by'], images)
+            await self.copy('post', ['id', 'title', 'text', 'created_time', 'modified_time', 'is_deleted', 'user_id',
+                                     'like_count', 'comment_count', 'score'], posts)
+            await self.copy('post_image', ['post_id', 'image_id'], links)
+            await self.copy('like', ['post_id', 'user_id'], likes)
+            await self.copy('comment', ['id', 'text', 'post_id', 'user_id', 'created_time', 'modified_time',
+                                        'is_deleted'], comments)
+            print(f"{min(start + CHUNK - 1, args.posts)}/{args.posts} posts", flush=True)
+
+
+async def upload(keys: list[str]):
+    from PIL import Image
+
+    from src import config
+    from src.api.sessions import s3_client
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (1080, 1080), 'gray').save(buffer, 'JPEG')
+    body = buffer.getvalue()
+    await s3_client.start()
+    try:
+        semaphore = asyncio.Semaphore(32)
+
+        async def put(key):
+            async with semaphore:
+                await s3_client.client.put_object(Bucket=config.S3_BUCKET, Key=key, Body=body)
+
+        await asyncio.gather(*(put(key) for key in keys))
+    finally:
+        await s3_client.stop()
+
+
+async def main(args):
+    from src.api.sessions import engine
+    from src.db.migrate import upgrade
+
+    start = time.perf_counter()
+    await asyncio.to_thread(upgrade)
+    async with engine.begin() as conn:
+        if args.truncate:
+            await conn.execute(text('TRUNCATE "user", image, post, "like", comment, user_image, post_image '
+                                    'RESTART IDENTITY CASCADE'))
+        elif await conn.scalar(text('SELECT EXISTS (SELECT FROM "user")')):
+            raise SystemExit("The database isn't empty, pass --truncate to wipe it")
+        seeder = Seeder((await conn.get_raw_connection()).driver_connection, args)
+        image_id = await seeder.users(args.password)
+        await seeder.posts(image_id)
+        for table in ('user', 'image', 'post', 'like', 'comment'):
+            await conn.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                                    f"(SELECT COALESCE(max(id), 0) + 1 FROM \"{table}\"), false)"))
+        await conn.execute(text('ANALYZE'))
+    if args.upload:
+        await upload([f'seed-{id:09d}.jpg' for id in range(1, seeder.counts['image'] + 1)])
+    await engine.dispose()
+    print(json.dumps({'rows': seeder.counts, 'seconds': round(time.perf_counter() - start, 1)}, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--posts", type=int, default=100_000)
+    parser.add_argument("--likes", type=int, default=1_000_000)
+    parser.add_argument("--comments", type=int, default=200_000)
+    parser.add_argument("--days", type=int, default=30, help="posts are spread over this many last days")
+    parser.add_argument("--image-share", type=float, default=0.3, help="share of posts with an image")
+    parser.add_argument("--tags", type=int, default=10_000, help="distinct rare words, one in every post")
+    parser.add_argument("--avatar-share", type=float, default=0.5, help="share of users with an avatar")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--truncate", action="store_true", help="wipe existing data first")
+    parser.add_argument("--upload", action="store_true", help="put a JPEG under every image key in S3")
+    asyncio.run(main(parser.parse_args()))
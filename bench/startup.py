@@ -0,0 +1,113 @@
+"""
+Cold start of the API: import time of src.api.main with its heaviest top level packages, and for a freshly
+spawned uvicorn the time until it answers, then the latency of the first burst of requests touching the
+database against the same burst once warm. Needs the database and S3 of the environment.
+
+    python -m bench.startup --runs 5 --burst 16
+    DB_POOL_PREWARM=0 python -m bench.startup  # without warming the pool at startup
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+IMPORT = "import time; start = time.perf_counter(); import src.api.main; print(time.perf_counter() - start)"
+
+
+def import_seconds() -> float:
+    return float(subprocess.run([sys.executable, '-c', IMPORT], check=True, capture_output=True,
+                                text=True).stdout)
+
+
+def heaviest_imports(top: int) -> dict:
+    # -X importtime lines are "import time: self | cumulative | name", self times summed per top level package
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import src.api.main'], check=True,
+                            capture_output=True, text=True).stderr
+    packages = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+\d+ \|\s+(\S+)$', line)
+        if match:
+            package = match.group(2).split('.')[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1))
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {name: round(microseconds / 1000, 1) for name, microseconds in heaviest}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def burst(http: aiohttp.ClientSession, url: str, size: int) -> float:
+    """
+    Slowest of size concurrent logins of a missing user, each one a database round trip without bcrypt
+    """
+    async def login():
+        start = time.perf_counter()
+        async with http.post(url + '/login', json={'login': 'bench-missing', 'password': 'x'}) as response:
+            await response.read()
+        return time.perf_counter() - start
+
+    return max(await asyncio.gather(*(login() for _ in range(size))))
+
+
+async def cold_start(size: int) -> dict:
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'src.api.main:app', '--port', str(port),
+                               '--log-level', 'warning'])
+    try:
+        async with aiohttp.ClientSession() as http:
+            while True:
+                if server.poll() is not None:
+                    raise SystemExit("The API exited during startup")
+                try:
+                    async with http.get(url + '/metrics') as response:
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.01)
+            ready = time.perf_counter() - start
+            first = await burst(http, url, size)
+            warm = await burst(http, url, size)
+        return {'ready': ready, 'first_burst': first, 'warm_burst': warm}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def main(args):
+    imports = [import_seconds() for _ in range(args.runs)]
+    starts = [await cold_start(args.burst) for _ in range(args.runs)]
+
+    def median_ms(key):
+        return round(statistics.median(run[key] for run in starts) * 1000, 1)
+
+    print(json.dumps({
+        'runs': args.runs,
+        'burst': args.burst,
+        'db_pool_prewarm': os.getenv('DB_POOL_PREWARM'),
+        'import_ms': round(statistics.median(imports) * 1000, 1),
+        'heaviest_imports_ms': heaviest_imports(args.top),
+        'ready_ms': median_ms('ready'),
+        'first_burst_max_ms': median_ms('first_burst'),
+        'warm_burst_max_ms': median_ms('warm_burst'),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--burst", type=int, default=16, help="concurrent requests right after startup")
+    parser.add_argument("--top", type=int, default=8, help="top level packages to list by import time")
+    asyncio.run(main(parser.parse_args()))
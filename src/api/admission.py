@@ -0,0 +1,216 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+
+from fastapi import Depends, HTTPException, Request
+from fastapi.dependencies.models import Dependant
+from fastapi.routing import APIRoute
+from prometheus_client import Counter, Gauge, Histogram
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+from src import config
+from src.api.security import access_policy
+from src.api.sessions import get_db_session, get_read_db_session, get_user_db_session
+
+REJECTED = Counter('admission_rejected_total', 'Requests refused by admission control or rate limits',
+                   ['route', 'reason'])
+QUEUED = Counter('admission_queued_total', 'Requests that waited for a slot', ['route'])
+QUEUE_WAIT = Histogram('admission_queue_wait_seconds', 'Wait for a slot, admitted or not', ['route'])
+WAITING = Gauge('admission_waiting', 'Requests waiting for a slot', ['route'])
+IN_PROGRESS = Gauge('admission_in_progress', 'Admitted requests in progress', ['route'])
+
+DB_SESSIONS = {get_db_session, get_read_db_session, get_user_db_session}
+
+
+def uses_database(dependant: Dependant) -> bool:
+    """
+    Whether a route or dependency takes a database session, directly or through its own dependencies
+    """
+    return any(dependency.call in DB_SESSIONS or uses_database(dependency)
+               for dependency in dependant.dependencies)
+
+
+class Gate:
+    """
+    At most limit holders at once, up to max_queue more wait in FIFO order. A slot is handed from release()
+    straight to the first waiter, so a newcomer can't overtake the queue
+    """
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+    def try_acquire(self) -> bool:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return True
+        return False
+
+    async def acquire(self, timeout: float) -> bool:
+        """
+        Waits for a slot at most timeout seconds, False if it didn't get one or the queue is full
+        """
+        if self.try_acquire():
+            return True
+        if len(self.waiters) >= self.max_queue:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # handed a slot just as the wait ended
+                self.release()
+            elif waiter in self.waiters:  # release() drops given up waiters itself
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionMiddleware:
+    """
+    Limits the requests in progress of all API routes taking a database session together to the size of the
+    database pool and lets a bounded number more wait a short while, so a burst is refused with 503 and
+    Retry-After at the door instead of queueing for database connections and slowing down everyone. Every route
+    is capped on its own as well, so that a slow one can't take all the slots. Routes without a database session,
+    like the image redirects, only pass their own gate. Routes are matched here the same way the router does it,
+    other paths pass through
+    """
+
+    def __init__(self, app, routes: list, limit: int, route_limit: int, route_limits: dict[str, int],
+                 max_queue: int, timeout_ms: int):
+        self.app = app
+        self.routes = routes
+        self.shared = Gate(limit, max_queue) if limit > 0 else None
+        self.route_limit = route_limit
+        self.route_limits = route_limits
+        self.max_queue = max_queue
+        self.timeout = timeout_ms / 1000
+        self.retry_after = str(max(1, math.ceil(self.timeout)))
+        self.gates: dict[str, list[Gate]] = {}
+
+    def route_gates(self, route: APIRoute) -> list[Gate]:
+        """
+        Gates a request of the route passes, its own one first so that its waiters don't hold shared slots
+        """
+        if route.path not in self.gates:
+            limit = self.route_limits.get(route.path, self.route_limit)
+            gates = [Gate(limit, self.max_queue)] if limit > 0 else []
+            if self.shared is not None and uses_database(route.dependant):
+                gates.append(self.shared)
+            self.gates[route.path] = gates
+        return self.gates[route.path]
+
+    def match(self, scope) -> APIRoute | None:
+        for route in self.routes:
+            if isinstance(route, APIRoute):
+                match, _ = route.matches(scope)
+                if match == Match.FULL:
+                    return route
+        return None
+
+    async def admit(self, path: str, gates: list[Gate]) -> bool:
+        """
+        Takes a slot of every gate in order waiting at most timeout in all, False and nothing taken if it can't
+        """
+        taken = []
+        start = None
+        try:
+            for gate in gates:
+                if not gate.try_acquire():
+                    if start is None:
+                        start = time.perf_counter()
+                        QUEUED.labels(path).inc()
+                        WAITING.labels(path).inc()
+                    if not await gate.acquire(max(0.0, start + self.timeout - time.perf_counter())):
+                        break
+                taken.append(gate)
+        except BaseException:
+            for gate in taken:
+                gate.release()
+            raise
+        finally:
+            if start is not None:
+                WAITING.labels(path).dec()
+                QUEUE_WAIT.labels(path).observe(time.perf_counter() - start)
+        if len(taken) < len(gates):
+            for gate in taken:
+                gate.release()
+            return False
+        return True
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        route = self.match(scope)
+        gates = self.route_gates(route) if route is not None else []
+        if not gates:
+            return await self.app(scope, receive, send)
+        # the router sets it again, for the metrics of requests refused here
+        scope['route'] = route
+        if not await self.admit(route.path, gates):
+            REJECTED.labels(route.path, 'overloaded').inc()
+            response = JSONResponse(status_code=503, headers={'Retry-After': self.retry_after},
+                                    content={'detail': [{'msg': "Server is busy, try again later"}]})
+            return await response(scope, receive, send)
+        IN_PROGRESS.labels(route.path).inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            IN_PROGRESS.labels(route.path).dec()
+            for gate in gates:
+                gate.release()
+
+
+class RateLimit:
+    """
+    Dependency refusing a user's requests with 429 once their token bucket is empty: burst requests at once,
+    then rate per second. Buckets live in the worker, full ones are forgotten
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: OrderedDict[int, tuple[float, float]] = OrderedDict()
+
+    def __call__(self, request: Request, credentials=Depends(access_policy)):
+        if self.rate <= 0:
+            return
+        user_id = credentials.subject['id']
+        now = time.monotonic()
+        # least recently used first, refilled to burst by now
+        while self.buckets:
+            oldest_user, (_, updated) = next(iter(self.buckets.items()))
+            if (now - updated) * self.rate < self.burst:
+                break
+            del self.buckets[oldest_user]
+        tokens, updated = self.buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[user_id] = (tokens, now)
+            REJECTED.labels(request.scope['route'].path, 'rate_limited').inc()
+            raise HTTPException(status_code=429, detail="Too many requests, try again later",
+                                headers={'Retry-After': str(math.ceil((1 - tokens) / self.rate))})
+        self.buckets[user_id] = (tokens - 1, now)
+
+
+# likes and unlikes share a bucket
+like_limit = RateLimit(config.LIKE_RATE, config.LIKE_BURST)
+post_add_limit = RateLimit(config.POST_ADD_RATE, config.POST_ADD_BURST)
+comment_limit = RateLimit(config.COMMENT_RATE, config.COMMENT_BURST)
+image_upload_limit = RateLimit(config.IMAGE_UPLOAD_RATE, config.IMAGE_UPLOAD_BURST)
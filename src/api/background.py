@@ -0,0 +1,23 @@
+import asyncio
+import logging
+
+from src import config
+from src.api.sessions import async_session
+from src.db import crud
+
+logger = logging.getLogger(__name__)
+
+
+async def refresh_post_scores_periodically():
+    """
+    Likes and comments keep Post.score exact on their own, this catches up posts after a change of the weights
+    """
+    while True:
+        try:
+            async with async_session() as session:
+                updated = await crud.refresh_post_scores(session)
+            if updated:
+                logger.info("Refreshed score of %s posts", updated)
+        except Exception:
+            logger.exception("Failed to refresh post scores")
+        await asyncio.sleep(config.POST_SCORE_REFRESH_SECONDS)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src import config
+from src.api.sessions import async_session
+from src.db import crud
+
+logger = logging.getLogger(__name__)
+
+JOBS = Counter('jobs_total', 'Background jobs by outcome: enqueued, done, retried, failed', ['queue', 'result'])
+JOB_TIME = Histogram('job_duration_seconds', 'Duration of a run of a background job', ['queue', 'result'])
+JOB_LAG = Histogram('job_lag_seconds', 'From when a job was due until a worker took it', ['queue'],
+                    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, float('inf')))
+RUNNING = Gauge('jobs_running', 'Background jobs running in this process', ['queue'])
+
+
+@dataclass
+class Handler:
+    run: Callable[[dict], Awaitable[None]]
+    concurrency: int
+    max_attempts: int
+
+
+class JobQueue:
+    """
+    Durable background jobs in the job table. Workers take due jobs with FOR UPDATE SKIP LOCKED, so any number
+    of API processes and `python -m src.manage worker` share the queues, each running at most concurrency
+    jobs of a queue at once. A job that raises is retried with exponential backoff, one whose worker died is
+    taken again when its lease runs out. The worker renews the lease of a running job every third of
+    JOB_LEASE_SECONDS, a run that still lost it can't change the job anymore
+    """
+
+    def __init__(self):
+        self.handlers: dict[str, Handler] = {}
+        self.wakeups: dict[str, asyncio.Event] = {}
+        self.task: asyncio.Task | None = None
+
+    def handler(self, queue: str, concurrency: int = 1, max_attempts: int | None = None):
+        """
+        Registers the decorated coroutine function as the handler of the queue, it gets the payload of a job
+        """
+        def register(run):
+            self.handlers[queue] = Handler(run, concurrency, max_attempts or config.JOB_MAX_ATTEMPTS)
+            return run
+        return register
+
+    async def enqueue(self, session: AsyncSession, queue: str, payload: dict, delay: float = 0) -> int:
+        id = await crud.add_job(session, queue, payload, self.handlers[queue].max_attempts, delay)
+        JOBS.labels(queue, 'enqueued').inc()
+        if queue in self.wakeups and not delay:
+            self.wakeups[queue].set()
+        return id
+
+    async def run(self, queues: list[str] | None = None):
+        """
+        Works on the queues, all registered ones by default, until cancelled
+        """
+        queues = queues or list(self.handlers)
+        unknown = set(queues) - set(self.handlers)
+        if unknown:
+            raise Exception(f"No handlers for job queues {', '.join(sorted(unknown))}")
+        await asyncio.gather(*(self.run_queue(queue) for queue in queues))
+
+    async def run_queue(self, queue: str):
+        handler = self.handlers[queue]
+        wakeup = self.wakeups.setdefault(queue, asyncio.Event())
+        running: set[asyncio.Task] = set()
+        try:
+            while True:
+                free = handler.concurrency - len(running)
+                if not free:
+                    await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                wakeup.clear()
+                try:
+                    async with async_session() as session:
+                        expired = await crud.fail_expired_jobs(session, queue)
+                        jobs = await crud.claim_jobs(session, queue, free, config.JOB_LEASE_SECONDS)
+                    if expired:
+                        JOBS.labels(queue, 'failed').inc(expired)
+                        logger.error("%s jobs of %s lost their worker on the last attempt", expired, queue)
+                except Exception:
+                    logger.exception("Failed to take jobs of %s", queue)
+                    jobs = []
+                for job in jobs:
+                    task = asyncio.create_task(self.run_job(queue, handler, job))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                if len(jobs) < free:
+                    # the queue is drained for now
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), config.JOB_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def run_job(self, queue: str, handler: Handler, job):
+        JOB_LAG.labels(queue).observe(max(0.0, job.lag))
+        RUNNING.labels(queue).inc()
+        start = time.perf_counter()
+        error = None
+        heartbeat = asyncio.create_task(self.renew_lease(queue, job))
+        try:
+            await handler.run(job.payload)
+            result = 'done'
+        except asyncio.CancelledError:
+            # shutting down: back to the queue right away, the interrupted run isn't an attempt
+            await self.record(queue, job, 'interrupted', None)
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts >= job.max_attempts:
+                result = 'failed'
+                logger.exception("Job %s of %s failed after %s attempts", job.id, queue, job.attempts)
+            else:
+                result = 'retried'
+                logger.warning("Job %s of %s failed on attempt %s: %s", job.id, queue, job.attempts, error)
+        finally:
+            heartbeat.cancel()
+            RUNNING.labels(queue).dec()
+        JOB_TIME.labels(queue, result).observe(time.perf_counter() - start)
+        JOBS.labels(queue, result).inc()
+        await self.record(queue, job, result, error)
+
+    @staticmethod
+    async def renew_lease(queue: str, job):
+        while True:
+            await asyncio.sleep(config.JOB_LEASE_SECONDS / 3)
+            try:
+                async with async_session() as session:
+                    if not await crud.extend_job_lease(session, job.id, job.attempts, config.JOB_LEASE_SECONDS):
+                        logger.warning("Job %s of %s lost its lease, another worker may run it", job.id, queue)
+                        return
+            except Exception:
+                logger.exception("Failed to renew the lease of job %s of %s", job.id, queue)
+
+    @staticmethod
+    async def record(queue: str, job, result: str, error: str | None):
+        try:
+            async with async_session() as session:
+                if result == 'done':
+                    recorded = await crud.finish_job(session, job.id, job.attempts)
+                elif result == 'failed':
+                    recorded = await crud.fail_job(session, job.id, job.attempts, error)
+                elif result == 'retried':
+                    recorded = await crud.retry_job(session, job.id, job.attempts, retry_delay(job.attempts), error)
+                else:
+                    recorded = await crud.retry_job(session, job.id, job.attempts, 0, None, attempt=False)
+        except Exception:
+            # the job stays running until its lease ends, then it is taken again
+            logger.exception("Failed to record that job %s of %s %s", job.id, queue, result)
+            return
+        if not recorded:
+            logger.warning("Job %s of %s %s after its lease ended, left to the run that took it", job.id, queue,
+                           result)
+
+    def start(self):
+        if config.JOB_WORKER_IN_API and self.handlers:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    Seconds before the next attempt after the given number of failed ones, jittered so that jobs failing
+    together don't come back together
+    """
+    delay = min(config.JOB_RETRY_MAX_SECONDS, config.JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+jobs = JobQueue()
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy.orm.attributes import set_committed_value
+
+from src import config
+from src.api.sessions import async_session, replicas
+from src.db import crud
+
+logger = logging.getLogger(__name__)
+
+FLUSHES = Counter('like_buffer_flushes_total', 'Flushes of the like buffer', ['result'])
+FLUSHED = Counter('like_buffer_flushed_likes_total', 'Likes written by flushes', ['operation'])
+COALESCED = Counter('like_buffer_coalesced_total', 'Likes/unlikes overwritten before being flushed')
+DROPPED = Counter('like_buffer_dropped_total', 'Likes/unlikes dropped after too many failed flushes')
+PENDING = Gauge('like_buffer_pending', 'Likes/unlikes waiting for a flush')
+FLUSH_TIME = Histogram('like_buffer_flush_seconds', 'Duration of a flush of the like buffer')
+
+
+class LikeBuffer:
+    """
+    Collects likes and unlikes for a short window and writes the last state of every (user, post) in one
+    transaction. In wait mode put() returns after that transaction is committed, in async mode right away
+    """
+
+    def __init__(self, mode: str, window_ms: int, max_size: int, max_failures: int):
+        if mode not in ('off', 'wait', 'async'):
+            raise Exception(f"Unknown LIKE_BUFFER_MODE {mode}")
+        self.mode = mode
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.max_failures = max_failures
+        # failed flushes of (user_id, post_id) put back by _restore
+        self.failures: dict[tuple[int, int], int] = {}
+        self.pending: dict[int, dict[int, bool]] = {}
+        self.size = 0
+        self.flushed: asyncio.Future | None = None
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    async def put(self, user_id: int, post_id: int, liked: bool):
+        user_pending = self.pending.setdefault(user_id, {})
+        if post_id in user_pending:
+            COALESCED.inc()
+        else:
+            self.size += 1
+            PENDING.inc()
+        user_pending[post_id] = liked
+        if self.size >= self.max_size:
+            self.full.set()
+        if self.mode == 'wait':
+            if self.flushed is None:
+                self.flushed = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self.flushed)
+
+    def overlay(self, user_id: int, posts: list):
+        """
+        Shows the user's own pending likes in posts read from the database, posts are ORM objects or dicts
+        """
+        user_pending = self.pending.get(user_id)
+        if not user_pending:
+            return
+        for post in posts:
+            is_dict = isinstance(post, dict)
+            id = post['id'] if is_dict else post.id
+            if id not in user_pending:
+                continue
+            liked = user_pending[id]
+            is_liked = post['is_liked'] if is_dict else post.is_liked
+            if bool(is_liked) == liked:
+                continue
+            like_count = (post['like_count'] if is_dict else post.like_count) + (1 if liked else -1)
+            if is_dict:
+                post['is_liked'], post['like_count'] = liked, like_count
+            else:
+                # the session must not see these as changes to flush
+                set_committed_value(post, 'is_liked', liked)
+                set_committed_value(post, 'like_count', like_count)
+
+    async def flush(self):
+        async with self.lock:
+            batch, self.pending, self.size = self.pending, {}, 0
+            waiters, self.flushed = self.flushed, None
+            self.full.clear()
+            if not batch:
+                return
+            likes = {(user_id, post_id): liked
+                     for user_id, user_pending in batch.items() for post_id, liked in user_pending.items()}
+            PENDING.dec(len(likes))
+            start = time.perf_counter()
+            try:
+                async with async_session() as session:
+                    inserted, deleted = await crud.apply_likes(session, likes)
+            except Exception as e:
+                FLUSHES.labels('error').inc()
+                logger.exception("Failed to flush %s likes", len(likes))
+                if waiters is not None:
+                    waiters.set_exception(e)
+                    waiters.exception()  # nobody may be awaiting it anymore
+                else:
+                    self._restore(batch)
+                return
+            FLUSH_TIME.observe(time.perf_counter() - start)
+            FLUSHES.labels('ok').inc()
+            FLUSHED.labels('insert').inc(inserted)
+            FLUSHED.labels('delete').inc(deleted)
+            for key in likes:
+                self.failures.pop(key, None)
+            await replicas.wrote(*batch)
+            if waiters is not None:
+                waiters.set_result(None)
+
+    def _restore(self, batch: dict[int, dict[int, bool]]):
+        # newer puts win over the failed batch, entries failed max_failures times are given up
+        for user_id, user_pending in batch.items():
+            current = self.pending.setdefault(user_id, {})
+            for post_id, liked in user_pending.items():
+                key = (user_id, post_id)
+                failures = self.failures.pop(key, 0) + 1
+                if post_id in current:
+                    continue
+                if failures >= self.max_failures:
+                    DROPPED.inc()
+                    continue
+                self.failures[key] = failures
+                current[post_id] = liked
+                self.size += 1
+                PENDING.inc()
+            if not current:
+                del self.pending[user_id]
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            # stop() cancels this loop, not a flush in the middle of its transaction
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            await self.flush()
+
+
+like_buffer = LikeBuffer(config.LIKE_BUFFER_MODE, config.LIKE_BUFFER_WINDOW_MS, config.LIKE_BUFFER_MAX_SIZE,
+                         config.LIKE_BUFFER_MAX_FAILURES)
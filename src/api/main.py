@@ -1,28 +1,52 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
+from src.api.admission import AdmissionMiddleware
 from src.api.common import models
+from src.api.background import refresh_post_scores_periodically
+from src.api.jobs import jobs
+from src.api.like_buffer import like_buffer
+from src.api.metrics import MetricsMiddleware, metrics_endpoint
 from src.api.routers import auth, users, posts, images
-from src.api.sessions import engine
-from src.db.schemas import Base, create_reccomended_func
+from src.api.routers.images.utils import forget_deleted_objects
+from src import config
+from src.api.sessions import engine, prewarm_pool, s3_client, replicas
 
 
 @asynccontextmanager
-async def init_db(app):
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        await create_reccomended_func(conn)
+async def lifespan(app):
+    # the schema is migrated by `python -m src.manage migrate` before the workers start, see Dockerfile
+    await s3_client.start()
+    if config.DB_POOL_PREWARM:
+        await asyncio.gather(s3_client.prewarm(), prewarm_pool(engine, config.DB_POOL_PREWARM),
+                             *(prewarm_pool(replica, config.DB_POOL_PREWARM) for replica in replicas.engines))
+    replicas.start()
+    scores_task = asyncio.create_task(refresh_post_scores_periodically())
+    deleted_objects_task = asyncio.create_task(forget_deleted_objects())
+    like_buffer.start()
+    jobs.start()
     yield
+    scores_task.cancel()
+    deleted_objects_task.cancel()
+    await jobs.stop()
+    await like_buffer.stop()
+    await s3_client.stop()
+    await replicas.stop()
 
 
-app = FastAPI(lifespan=init_db)
+app = FastAPI(lifespan=lifespan)
 app.include_router(auth.endpoints.router)
 app.include_router(users.endpoints.router)
 app.include_router(posts.endpoints.router)
 app.include_router(images.endpoints.router)
+# inside CORS, so that refusals carry its headers, and inside metrics, so that they are counted
+app.add_middleware(AdmissionMiddleware, routes=app.routes, limit=config.ADMISSION_LIMIT,
+                   route_limit=config.ADMISSION_ROUTE_LIMIT, route_limits=config.ADMISSION_ROUTE_LIMITS,
+                   max_queue=config.ADMISSION_QUEUE_SIZE, timeout_ms=config.ADMISSION_QUEUE_TIMEOUT_MS)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],
@@ -30,12 +54,15 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_route('/metrics', metrics_endpoint, include_in_schema=False)
 
 
 @app.exception_handler(404)
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc) -> JSONResponse:
     content = models.Error(detail=[models.ErrorDetails(msg=exc.detail)])
-    return JSONResponse(status_code=exc.status_code, content=content.model_dump())
+    return JSONResponse(status_code=exc.status_code, content=content.model_dump(),
+                        headers=getattr(exc, 'headers', None))
 
 
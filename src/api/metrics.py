@@ -0,0 +1,108 @@
+import time
+from contextvars import ContextVar
+
+from prometheus_client import Histogram, CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from starlette.responses import Response
+
+REQUEST_TIME = Histogram('http_request_duration_seconds', 'Duration of HTTP requests', ['route', 'method', 'status'])
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL statements executed per HTTP request', ['route'],
+                            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, float('inf')))
+QUERY_TIME = Histogram('db_query_duration_seconds', 'Duration of SQL statements', ['route'])
+POOL_CHECKOUT_TIME = Histogram('db_pool_checkout_seconds', 'Wait for a connection from the pool', ['route'])
+S3_TIME = Histogram('s3_request_duration_seconds', 'Duration of S3 requests', ['route', 'operation'])
+
+
+class RequestStats:
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.queries = 0
+
+    @property
+    def route(self) -> str:
+        # FastAPI puts the matched route into the scope before dependencies and the endpoint run
+        route = self.scope.get('route')
+        return route.path if route is not None else 'unmatched'
+
+
+request_stats: ContextVar[RequestStats | None] = ContextVar('request_stats', default=None)
+
+
+def current_route() -> str:
+    stats = request_stats.get()
+    return stats.route if stats is not None else 'background'
+
+
+class MetricsMiddleware:
+    """
+    Times HTTP requests and lets the database and S3 hooks attribute their work to the route being served.
+    Queries of background tasks count to the request that scheduled them, other work to the "background" route
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = RequestStats(scope)
+        token = request_stats.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_stats.reset(token)
+            route = stats.route
+            REQUEST_TIME.labels(route, scope['method'], str(status)).observe(time.perf_counter() - start)
+            REQUEST_QUERIES.labels(route).observe(stats.queries)
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """
+    Queue pool which reports how long a checkout waited, including connecting when the pool isn't full
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_TIME.labels(current_route()).observe(time.perf_counter() - start)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+        QUERY_TIME.labels(current_route()).observe(time.perf_counter() - context._metrics_start)
+
+
+def instrument_s3_client(client):
+    def before_call(model, context, **kwargs):
+        context['metrics_start'] = time.perf_counter()
+
+    def after_call(model, context, **kwargs):
+        if 'metrics_start' in context:
+            S3_TIME.labels(current_route(), model.name).observe(time.perf_counter() - context['metrics_start'])
+
+    client.meta.events.register('before-call.s3', before_call)
+    client.meta.events.register('after-call.s3', after_call)
+
+
+async def metrics_endpoint(request) -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
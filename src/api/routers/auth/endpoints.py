@@ -5,9 +5,9 @@ from fastapi_jwt import JwtAuthorizationCredentials
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.api.routers.auth import models
-from src.api.routers.auth.utils import get_hash_password, verify_password
+from src.api.routers.auth.utils import get_hash_password, verify_and_update_password, HashingOverloaded
 from src.api.security import access_policy, refresh_policy
-from src.api.sessions import get_db_session
+from src.api.sessions import get_db_session, replicas
 from src.db import crud
 
 router = APIRouter(
@@ -15,13 +15,22 @@ router = APIRouter(
 )
 
 
+def overloaded():
+    return HTTPException(status_code=503, detail="Too many logins, try again later", headers={"Retry-After": "1"})
+
+
 @router.post("/register", response_model=models.TokenResponse)
 async def register(user: models.UserCreate, session: AsyncSession = Depends(get_db_session)):
     res = await crud.get_user_by_login(session, user.login)
     if res:
         raise HTTPException(status_code=400, detail="Login already registered")
-    hashed_password = get_hash_password(user.password)
+    try:
+        hashed_password = await get_hash_password(user.password)
+    except HashingOverloaded:
+        raise overloaded()
     res = await crud.add_user(session, user.login, user.name, hashed_password)
+    # not an authorized session, so the user's first reads are sent to the primary here
+    await replicas.wrote(res.id)
     subject = {"login": user.login, "name": user.name, "id": res.id}
     access_token = access_policy.create_access_token(subject=subject)
     refresh_token = refresh_policy.create_refresh_token(subject=subject)
@@ -33,7 +42,14 @@ async def register(user: models.UserCreate, session: AsyncSession = Depends(get_
 async def login(user: models.UserLogin, session: AsyncSession = Depends(get_db_session)):
     res = await crud.get_user_by_login(session, user.login)
     if res:
-        if verify_password(user.password, res.password):
+        try:
+            verified, new_hash = await verify_and_update_password(user.password, res.password)
+        except HashingOverloaded:
+            raise overloaded()
+        if verified:
+            if new_hash is not None:
+                await crud.update_user_password(session, res.id, new_hash)
+                await replicas.wrote(res.id)
             subject = {"login": res.login, "name": res.name, "id": res.id}
             access_token = access_policy.create_access_token(subject=subject)
             refresh_token = refresh_policy.create_refresh_token(subject=subject)
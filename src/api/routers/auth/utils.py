@@ -1,12 +1,49 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from src import config
+
+# min/max rounds equal to the default make needs_update true for hashes made with another cost
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=config.BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=config.BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=config.BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so threads hash in parallel without blocking the event loop
+hash_pool = ThreadPoolExecutor(max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+hash_queue_depth = 0
+
+
+class HashingOverloaded(Exception):
+    pass
+
+
+async def run_in_hash_pool(func, *args):
+    """
+    Runs func in hash_pool, raises HashingOverloaded instead of queueing more than PASSWORD_HASH_MAX_QUEUE calls
+    """
+    global hash_queue_depth
+    if hash_queue_depth >= config.PASSWORD_HASH_MAX_QUEUE:
+        raise HashingOverloaded()
+    hash_queue_depth += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_pool, func, *args)
+    finally:
+        hash_queue_depth -= 1
+
 
+async def verify_password(password: str, hashed_password) -> bool:
+    return await run_in_hash_pool(pwd_context.verify, password, hashed_password)
 
-def verify_password(password: str, hashed_password):
-    return pwd_context.verify(password, hashed_password)
 
+async def verify_and_update_password(password: str, hashed_password) -> tuple[bool, str | None]:
+    """
+    Like verify_password, also returns a new hash when the stored one was made with another cost
+    """
+    return await run_in_hash_pool(pwd_context.verify_and_update, password, hashed_password)
 
-def get_hash_password(password: str):
-    return pwd_context.hash(password)
 
+async def get_hash_password(password: str):
+    return await run_in_hash_pool(pwd_context.hash, password)
@@ -1,14 +1,17 @@
-import random
+import asyncio
 
-from PIL import Image, ImageOps
 from fastapi import APIRouter, UploadFile, Depends, HTTPException
 from fastapi.responses import RedirectResponse
 
 from src import config
+from src.api.admission import image_upload_limit
+from src.api.jobs import jobs
 from src.api.routers.images.models import UploadResponse
+from src.api.routers.images.utils import get_upload_image_size, upload_image, sha256_file, get_presigned_url, \
+    image_extension
 from src.api.security import access_policy
-from src.api.sessions import get_s3_session_async, get_db_session
-from src.db.crud import add_image
+from src.api.sessions import get_s3_client, get_user_db_session
+from src.db.crud import add_image, reuse_image
 
 router = APIRouter(
     prefix="/image",
@@ -18,25 +21,43 @@ router = APIRouter(
 )
 
 
-@router.post("/upload", response_model=UploadResponse)
-async def upload_frames(file: UploadFile,
-                        s3=Depends(get_s3_session_async), session=Depends(get_db_session),
+def being_deleted() -> HTTPException:
+    # gc-images is deleting the objects of this content, the stored copy may be gone in a moment
+    return HTTPException(status_code=503, detail="The same image is being deleted, try again",
+                         headers={'Retry-After': '5'})
+
+
+@router.post("/upload", response_model=UploadResponse, dependencies=[Depends(image_upload_limit)])
+async def upload_frames(file: UploadFile, s3=Depends(get_s3_client), session=Depends(get_user_db_session),
                         credentials=Depends(access_policy)):
-    if file.filename.split(".")[-1] not in config.ALLOWED_IMAGE_EXTENSIONS:
-        HTTPException(status_code=400, detail="Wrong file extension!")
-    hash_name = f'{random.randbytes(15).hex()}.{file.filename.split(".")[-1]}'
-    async with s3 as s3_session:
-        await s3_session.upload_fileobj(file.file, config.S3_BUCKET, hash_name)
-    pil = Image.open(file.file)
-    pil = ImageOps.exif_transpose(pil)
-    width, height = pil.size
-    await add_image(session, credentials.subject['id'], hash_name, width, height)
+    extension = file.filename.split(".")[-1].lower()
+    if extension not in config.ALLOWED_IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Wrong file extension!")
+    if file.size is not None and file.size > config.MAX_IMAGE_SIZE:
+        raise HTTPException(status_code=413, detail="File is too large!")
+    # content addressed: the same file uploaded again, under any name, reuses the stored object and its metadata
+    digest = await asyncio.to_thread(sha256_file, file.file)
+    image = await reuse_image(session, [f'{digest}.{known}' for known in config.ALLOWED_IMAGE_EXTENSIONS])
+    if image is not None and image.is_deleted:
+        raise being_deleted()
+    if image is not None:
+        return {'hash': image.hash, 'width': image.width, 'height': image.height}
+    try:
+        width, height = await get_upload_image_size(file)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="File is not an image!")
+    hash_name = f'{digest}.{image_extension(await file.read(8), extension)}'
+    await file.seek(0)
+    await upload_image(s3, file, hash_name)
+    image = await add_image(session, credentials.subject['id'], hash_name, width, height)
+    if image.is_deleted:
+        raise being_deleted()
+    # lost if the process dies right here, backfill-variants catches such images up
+    await jobs.enqueue(session, 'image.variants', {'key': hash_name})
     return {'hash': hash_name, 'width': width, 'height': height}
 
 
 @router.get('/{hash:str}')
-async def get_image(hash: str, s3=Depends(get_s3_session_async)):
-    async with s3 as s3_session:
-        url = await s3_session.generate_presigned_url('get_object', Params={'Bucket': config.S3_BUCKET, 'Key': hash},
-                                                      ExpiresIn=3600)
-        return RedirectResponse(url=url)
+async def get_image(hash: str):
+    url, max_age = await get_presigned_url(hash)
+    return RedirectResponse(url=url, headers={'Cache-Control': f'private, max-age={max_age}'})
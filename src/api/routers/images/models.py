@@ -1,16 +1,17 @@
 import urllib3
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from pydantic.functional_validators import AfterValidator
 from typing_extensions import Annotated
 
 from src import config
-from src.api.sessions import get_s3_session_sync
+from src.api.routers.images.utils import variant_key
 
+base_url = urllib3.util.parse_url(config.S3_URL).url + '/' + config.S3_BUCKET + '/'
 
 
 def hash_to_url(hash: str) -> str:
-    return urllib3.util.parse_url(config.S3_URL).url + '/' + config.S3_BUCKET + '/' + hash
+    return base_url + hash
 
 
 image_url = Annotated[str, AfterValidator(hash_to_url)]
@@ -22,7 +23,37 @@ class UploadResponse(BaseModel):
     height: int
 
 
+class ImageVariant(BaseModel):
+    width: int
+    url: str
+
+
 class ImageResponse(BaseModel):
     url: image_url = Field(None, validation_alias='hash')
     width: int
     height: int
+    variant_widths: list[int] | None = Field(None, exclude=True)
+    variants: list[ImageVariant] = []
+    srcset: str | None = None
+
+    @model_validator(mode='after')
+    def fill_variants(self):
+        if self.variant_widths:
+            self.variants = [ImageVariant(width=width, url=variant_key(self.url, width))
+                             for width in self.variant_widths]
+            self.srcset = ', '.join(f'{variant.url} {variant.width}w' for variant in self.variants) \
+                          + f', {self.url} {self.width}w'
+        return self
+
+
+def image_response(image: dict) -> dict:
+    """
+    ImageResponse of image_to_dict() output as plain data, without building the model
+    """
+    url = base_url + image['hash']
+    variants = [{'width': width, 'url': variant_key(url, width)} for width in image['variant_widths'] or ()]
+    srcset = None
+    if variants:
+        srcset = ', '.join(f"{variant['url']} {variant['width']}w" for variant in variants) \
+                 + f", {url} {image['width']}w"
+    return {'url': url, 'width': image['width'], 'height': image['height'], 'variants': variants, 'srcset': srcset}
@@ -1,7 +1,31 @@
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
 import os
 import struct
-from tempfile import SpooledTemporaryFile
-from typing import BinaryIO
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import UploadFile
+from prometheus_client import Counter
+from sqlalchemy import func, select
+
+from src import config
+from src.api.jobs import jobs
+from src.api.sessions import async_session, engine, get_s3_client
+from src.db import crud
+from src.db.cache import MemoryBackend
+
+logger = logging.getLogger(__name__)
+
+PRESIGNED_URLS = Counter('presigned_url_cache_requests_total', 'Lookups in the presigned url cache', ['result'])
+
+# enough for the largest APP1 (EXIF) segment, which comes before the dimensions of a JPEG
+PROBE_SIZE = 128 * 1024
+# NOTIFY channel of storage keys deleted by gc-images
+DELETED_OBJECTS_CHANNEL = 'deleted_objects'
 
 
 def get_image_size(filepath):
@@ -14,7 +38,7 @@ def get_image_size(filepath):
     height = -1
     width = -1
 
-    if isinstance(filepath, SpooledTemporaryFile):  # file-like object
+    if hasattr(filepath, 'read'):  # file-like object, left open
         fhandle = filepath
     else:
         fhandle = open(filepath, 'rb')
@@ -110,7 +134,7 @@ def get_image_size(filepath):
         elif size >= 8 and head.startswith(b"\x49\x49\x2b\x00"):
             bytesize_offset = struct.unpack('<L', head[4:8])[0]
             if bytesize_offset != 8:
-                raise ValueError('Invalid BigTIFF file: Expected offset to be 8, found {} instead.'.format(offset))
+                raise ValueError('Invalid BigTIFF file: Expected offset to be 8, found {} instead.'.format(bytesize_offset))
             offset = struct.unpack('<Q', head[8:16])[0]
             fhandle.seek(offset)
             ifdsize = struct.unpack("<Q", fhandle.read(8))[0]
@@ -173,6 +197,343 @@ def get_image_size(filepath):
             else:
                 raise ValueError("Unsupported WebP file")
     finally:
-        fhandle.close()
+        if fhandle is not filepath:
+            fhandle.close()
+
+    return width, height
+
+
+def _tiff_orientation(tiff: bytes) -> int:
+    order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if order is None:
+        raise ValueError("Invalid EXIF")
+    offset = struct.unpack(order + 'L', tiff[4:8])[0]
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    for i in range(count):
+        entry = tiff[offset + 2 + 12 * i:offset + 14 + 12 * i]
+        tag, = struct.unpack(order + 'H', entry[:2])
+        if tag == 0x0112:
+            return struct.unpack(order + 'H', entry[8:10])[0]
+    return 1
+
+
+def get_exif_orientation(fhandle) -> int:
+    """
+    Return EXIF orientation (1-8) of a JPEG or PNG, 1 if it has none or is of another format
+    :raises ValueError: the file ends before the EXIF data or its end could be found
+    """
+    fhandle.seek(0)
+    head = fhandle.read(8)
+    try:
+        if head.startswith(b'\377\330'):
+            fhandle.seek(2)
+            while True:
+                marker = fhandle.read(2)
+                if len(marker) < 2:
+                    raise ValueError("Truncated JPEG")
+                if marker[0] != 0xff or marker[1] in (0xd9, 0xda):  # EOI, SOS: no more metadata
+                    return 1
+                length = struct.unpack('>H', fhandle.read(2))[0]
+                data = fhandle.read(length - 2)
+                if marker[1] == 0xe1 and data[:6] == b'Exif\0\0':
+                    return _tiff_orientation(data[6:])
+        elif head == b'\211PNG\r\n\032\n':
+            while True:
+                length, chunk = struct.unpack('>L4s', fhandle.read(8))
+                if chunk == b'IDAT':  # eXIf must come before the image data
+                    return 1
+                data = fhandle.read(length)
+                fhandle.seek(4, os.SEEK_CUR)  # CRC
+                if chunk == b'eXIf':
+                    return _tiff_orientation(data)
+    except struct.error:
+        raise ValueError("Invalid EXIF")
+    return 1
+
+
+def probe_image_size(head: bytes) -> tuple[int, int]:
+    """
+    Return (width, height) as displayed, i.e. after EXIF orientation, from the first bytes of an image
+    :raises ValueError: the dimensions are not within head
+    """
+    try:
+        width, height = get_image_size(io.BytesIO(head))
+        orientation = get_exif_orientation(io.BytesIO(head))
+    except (struct.error, IndexError, OverflowError) as e:  # offsets of a crafted header point outside of it
+        raise ValueError("Invalid image header") from e
+    if width <= 0 or height <= 0:
+        raise ValueError("Unknown image format")
+    if orientation in (5, 6, 7, 8):  # rotated by 90 degrees
+        width, height = height, width
+    return width, height
+
+
+def pil_image_size(fhandle) -> tuple[int, int]:
+    """
+    Same as probe_image_size with PIL, which reads only the header as well but knows every format. Blocking
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(fhandle) as image:
+            width, height = image.size
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):
+                width, height = height, width
+    except (UnidentifiedImageError, OSError, SyntaxError, struct.error, Image.DecompressionBombError) as e:
+        # some plugins report a broken header with SyntaxError or struct.error
+        raise ValueError("Not an image") from e
+    return width, height
+
+
+def image_extension(head: bytes, extension: str) -> str:
+    """
+    Extension of the stored object by the format of the image, so that the same content gets the same key however
+    the file was named. The given one, normalized, when the format isn't one of those told apart here
+    """
+    if head.startswith(b'\377\330'):
+        return 'jpg'
+    if head.startswith(b'\211PNG\r\n\032\n'):
+        return 'png'
+    return 'jpg' if extension == 'jpeg' else extension
+
+
+def sha256_file(fhandle, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Hex sha256 of the whole file, leaves it at the start. Blocking, hashlib releases the GIL on large chunks
+    """
+    digest = hashlib.sha256()
+    fhandle.seek(0)
+    while chunk := fhandle.read(chunk_size):
+        digest.update(chunk)
+    fhandle.seek(0)
+    return digest.hexdigest()
+
+
+async def get_upload_image_size(file: UploadFile) -> tuple[int, int]:
+    """
+    Dimensions of an uploaded image, PIL runs in a worker thread only when the header probe can't tell
+    """
+    head = await file.read(PROBE_SIZE)
+    await file.seek(0)
+    try:
+        return probe_image_size(head)
+    except ValueError:
+        pass
+    try:
+        return await asyncio.to_thread(pil_image_size, file.file)
+    finally:
+        await file.seek(0)
+
+
+async def upload_image(s3, file: UploadFile, key: str):
+    """
+    Files up to one chunk go in a single PutObject, larger ones as a multipart upload reading chunks from the
+    spooled upload with at most S3_UPLOAD_CONCURRENCY parts in flight
+    """
+    if file.size is not None and file.size <= config.S3_MULTIPART_CHUNK_SIZE:
+        await s3.put_object(Bucket=config.S3_BUCKET, Key=key, Body=await file.read())
+        return
+    from boto3.s3.transfer import TransferConfig
+
+    transfer = TransferConfig(multipart_chunksize=config.S3_MULTIPART_CHUNK_SIZE,
+                              max_concurrency=config.S3_UPLOAD_CONCURRENCY,
+                              max_io_queue=config.S3_UPLOAD_CONCURRENCY)
+    await s3.upload_fileobj(file, config.S3_BUCKET, key, Config=transfer)
+
+
+def variant_key(key: str, width: int) -> str:
+    return f'{key.rsplit(".", 1)[0]}_{width}.webp'
+
+
+def make_variants(data: bytes, widths: list[int], quality: int) -> dict[int, bytes]:
+    """
+    Return WebP copies of an image scaled down to each of widths narrower than the image. Runs in variant_pool
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        variants = {}
+        for width in sorted(widths):
+            if width >= image.width:
+                break
+            height = max(1, round(image.height * width / image.width))
+            buffer = io.BytesIO()
+            image.resize((width, height), Image.LANCZOS).save(buffer, 'WEBP', quality=quality)
+            variants[width] = buffer.getvalue()
+    return variants
+
+
+variant_pool: ProcessPoolExecutor | None = None
+
+
+def get_variant_pool() -> ProcessPoolExecutor:
+    global variant_pool
+    if variant_pool is None:
+        # spawn, not fork: the parent runs an event loop and driver threads
+        variant_pool = ProcessPoolExecutor(max_workers=config.IMAGE_VARIANT_WORKERS,
+                                           mp_context=multiprocessing.get_context('spawn'))
+    return variant_pool
+
+
+async def generate_variants(key: str):
+    """
+    Stores IMAGE_VARIANTS of the image under key next to it and records their widths
+    """
+    s3 = await get_s3_client()
+    original = await s3.get_object(Bucket=config.S3_BUCKET, Key=key)
+    data = await original['Body'].read()
+    variants = await asyncio.get_running_loop().run_in_executor(
+        get_variant_pool(), make_variants, data, config.IMAGE_VARIANTS, config.IMAGE_VARIANT_QUALITY)
+    await asyncio.gather(*(s3.put_object(Bucket=config.S3_BUCKET, Key=variant_key(key, width), Body=body,
+                                         ContentType='image/webp')
+                           for width, body in variants.items()))
+    async with async_session() as session:
+        await crud.set_image_variants(session, key, sorted(variants))
+
+
+@jobs.handler('image.variants', concurrency=config.IMAGE_VARIANT_WORKERS)
+async def image_variants_job(payload: dict):
+    await generate_variants(payload['key'])
+
+
+async def image_objects(s3, image, live: set[str]) -> dict[str, int]:
+    """
+    Sizes by key of the objects of an image found in storage: the original and the variants, also those
+    missing from variant_widths. Variants are shared by the same content uploaded with another extension,
+    they are left alone while such an image is in live
+    """
+    stem = image.hash.rsplit('.', 1)[0]
+    siblings = {f'{stem}.{extension}' for extension in config.ALLOWED_IMAGE_EXTENSIONS} - {image.hash}
+    response = await s3.list_objects_v2(Bucket=config.S3_BUCKET, Prefix=stem)
+    return {obj['Key']: obj['Size'] for obj in response.get('Contents', [])
+            if obj['Key'] == image.hash or (obj['Key'].startswith(stem + '_') and not siblings & live)}
+
+
+async def delete_objects(s3, keys: list[str]) -> set[str]:
+    """
+    Deletes keys with DeleteObjects, up to 1000 per request as S3 allows. Returns the keys that failed
+    """
+    failed = set()
+    for start in range(0, len(keys), 1000):
+        chunk = keys[start:start + 1000]
+        try:
+            response = await s3.delete_objects(Bucket=config.S3_BUCKET, Delete={
+                'Objects': [{'Key': key} for key in chunk], 'Quiet': True})
+        except Exception:
+            logger.exception("Failed to delete %s objects", len(chunk))
+            failed.update(chunk)
+            continue
+        for error in response.get('Errors', []):
+            logger.error("Failed to delete %s: %s", error['Key'], error.get('Message'))
+            failed.add(error['Key'])
+    return failed
+
+
+async def collect_orphaned_images(grace_seconds: float, batch: int, dry_run: bool = False) -> dict | None:
+    """
+    Deletes the objects of images unreferenced for more than grace_seconds and marks them deleted, batch images
+    at a time. Images whose objects failed to delete stay marked as being deleted and are retried by the next
+    run. Returns counts of images, objects and bytes, only counted with dry_run, or None when another run holds
+    the lock
+    """
+    result = {'dry_run': dry_run, 'images': 0, 'objects': 0, 'bytes': 0, 'failed_images': 0}
+    s3 = await get_s3_client()
+    async with engine.connect() as lock:
+        if not await lock.scalar(select(func.pg_try_advisory_lock(func.hashtext('gc_images')))):
+            return None
+        await lock.commit()
+        try:
+            # left by runs that died between marking and deleting come first
+            after_id, after, leftovers = 0, None, True
+            while True:
+                async with async_session() as session:
+                    if dry_run:
+                        images = await crud.get_orphaned_images(session, grace_seconds, batch, after)
+                    elif leftovers:
+                        images = await crud.get_images_being_deleted(session, batch, after_id)
+                        if not images:
+                            leftovers = False
+                            continue
+                    else:
+                        images = await crud.mark_orphaned_images(session, grace_seconds, batch)
+                    if not images:
+                        break
+                    stems = {image.hash.rsplit('.', 1)[0] for image in images}
+                    live = await crud.get_live_image_hashes(session, [
+                        f'{stem}.{extension}' for stem in stems for extension in config.ALLOWED_IMAGE_EXTENSIONS])
+                live -= {image.hash for image in images}
+                after_id, after = images[-1].id, (images[-1].orphaned_time, images[-1].id)
+
+                objects = await asyncio.gather(*(image_objects(s3, image, live) for image in images))
+                # the same content with two extensions shares its variants
+                sizes = {key: size for image_keys in objects for key, size in image_keys.items()}
+                failed = set() if dry_run else await delete_objects(s3, list(sizes))
+                deleted = [image for image, image_keys in zip(images, objects) if not failed & image_keys.keys()]
+                if not dry_run:
+                    async with async_session() as session:
+                        await crud.notify_deleted_objects(session, DELETED_OBJECTS_CHANNEL,
+                                                          [key for key in sizes if key not in failed])
+                        await crud.set_images_deleted(session, [image.id for image in deleted])
+                result['images'] += len(deleted)
+                result['failed_images'] += len(images) - len(deleted)
+                result['objects'] += len(sizes.keys() - failed)
+                result['bytes'] += sum(size for key, size in sizes.items() if key not in failed)
+                if failed:
+                    # storage is failing, the rest waits for the next run
+                    break
+        finally:
+            await lock.scalar(select(func.pg_advisory_unlock(func.hashtext('gc_images'))))
+            await lock.commit()
+    return result
+
+
+presigned_urls = MemoryBackend(config.PRESIGNED_URL_CACHE_SIZE,
+                               config.PRESIGNED_URL_EXPIRES - config.PRESIGNED_URL_MARGIN)
+
+
+async def get_presigned_url(key: str) -> tuple[str, int]:
+    """
+    Return a presigned GET url of key and for how many seconds more it may be reused. Signs only on a cache miss
+    """
+    entry = await presigned_urls.get(key)
+    if entry is None:
+        PRESIGNED_URLS.labels('miss').inc()
+        s3 = await get_s3_client()
+        url = await s3.generate_presigned_url('get_object', Params={'Bucket': config.S3_BUCKET, 'Key': key},
+                                              ExpiresIn=config.PRESIGNED_URL_EXPIRES)
+        entry = (url, time.monotonic() + presigned_urls.ttl)
+        await presigned_urls.set(key, entry)
+    else:
+        PRESIGNED_URLS.labels('hit').inc()
+    url, reusable_until = entry
+    return url, max(0, int(reusable_until - time.monotonic()))
+
+
+async def forget_deleted_objects():
+    """
+    Drops cached presigned urls of objects gc-images deleted in any process, told by NOTIFY on its own
+    connection. Until it reconnects after losing that connection, deleted urls are served until they expire
+    """
+    import asyncpg
 
-    return width, height
\ No newline at end of file
+    while True:
+        deleted: asyncio.Queue[str | None] = asyncio.Queue()
+        try:
+            connection = await asyncpg.connect(config.DB_URL.replace('+asyncpg', ''))
+        except Exception as e:
+            logger.warning("Failed to listen for deleted objects: %r", e)
+            await asyncio.sleep(5)
+            continue
+        try:
+            connection.add_termination_listener(lambda _: deleted.put_nowait(None))
+            await connection.add_listener(DELETED_OBJECTS_CHANNEL,
+                                          lambda _connection, _pid, _channel, payload: deleted.put_nowait(payload))
+            while (payload := await deleted.get()) is not None:
+                for key in payload.split(','):
+                    await presigned_urls.delete(key)
+            logger.warning("Lost the connection listening for deleted objects, reconnecting")
+        finally:
+            await connection.close()
@@ -1,12 +1,16 @@
 from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from src.api.admission import like_limit, post_add_limit, comment_limit
+from src.api.like_buffer import like_buffer
 from src.api.routers.posts.models import PostAdd, PostResponse, PostsListResponse, CommentAdd, CommentResponse, \
-    CommentListResponse
+    CommentListResponse, PostDetailResponse, posts_list_response, post_detail_response
 from src.api.security import access_policy
-from src.api.sessions import get_db_session
+from src.api.sessions import get_read_db_session, get_user_db_session
 from src.db.crud import get_posts, get_post_by_id, add_post, add_comment, delete_comment, get_comment_by_id, \
-    get_comments, set_like, delete_like, get_posts_user_id, get_most_liked_posts
+    get_comments, set_like, delete_like, get_posts_user_id, get_most_liked_posts, search_posts, get_post_detail
+from src.db.utils import decode_cursor, decode_search_cursor, CountMode
 
 router = APIRouter(
     prefix='/post',
@@ -14,77 +18,144 @@ router = APIRouter(
 )
 
 
-@router.post("/add", response_model=PostResponse, tags=["posts"])
-async def add(post: PostAdd, session: AsyncSession = Depends(get_db_session), credentials=Depends(access_policy)):
+def get_cursor(cursor: str | None = Query(None, description="next_cursor of the previous page, "
+                                                            "when set page is ignored")):
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def get_search_cursor(cursor: str | None = Query(None, description="next_cursor of the previous page")):
+    if cursor is None:
+        return None
+    try:
+        return decode_search_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def get_count_mode(count: CountMode = Query(CountMode.exact,
+                                            description="exact count, estimated (planner or counter) or none")):
+    return count
+
+
+@router.post("/add", response_model=PostResponse, tags=["posts"], dependencies=[Depends(post_add_limit)])
+async def add(post: PostAdd, session: AsyncSession = Depends(get_user_db_session), credentials=Depends(access_policy)):
     res = await add_post(session, credentials.subject['id'], post.title, post.text, post.images)
     return res
 
 
 @router.get("/latests", response_model=PostsListResponse, tags=["posts"])
-async def get_posts_list(session: AsyncSession = Depends(get_db_session), page: int = Query(1, ge=1),
-                         per_page: int = Query(100, ge=0), credentials=Depends(access_policy)):
-    limit = per_page * page
+async def get_posts_list(session: AsyncSession = Depends(get_read_db_session), page: int = Query(1, ge=1),
+                         per_page: int = Query(100, ge=0), cursor=Depends(get_cursor),
+                         count_mode=Depends(get_count_mode), credentials=Depends(access_policy)):
+    limit = per_page
     offset = (page - 1) * per_page
-    res = await get_posts(session, limit, offset, user_id=credentials.subject['id'])
+    res = await get_posts(session, limit, offset, user_id=credentials.subject['id'], after=cursor,
+                          count_mode=count_mode)
+    like_buffer.overlay(credentials.subject['id'], res['items'])
 
-    return res
+    return ORJSONResponse(posts_list_response(res))
 
 
 @router.get("/recommended", response_model=PostsListResponse, tags=["posts"])
-async def get_recommended_posts(session: AsyncSession = Depends(get_db_session), page: int = Query(1, ge=1),
-                                per_page: int = Query(100, ge=0), credentials=Depends(access_policy)):
-    limit = per_page * page
+async def get_recommended_posts(session: AsyncSession = Depends(get_read_db_session), page: int = Query(1, ge=1),
+                                per_page: int = Query(100, ge=0), count_mode=Depends(get_count_mode),
+                                credentials=Depends(access_policy)):
+    limit = per_page
     offset = (page - 1) * per_page
-    res = await get_most_liked_posts(session, limit, offset, user_id=credentials.subject['id'])
+    res = await get_most_liked_posts(session, limit, offset, user_id=credentials.subject['id'],
+                                     count_mode=count_mode)
+    like_buffer.overlay(credentials.subject['id'], res['items'])
 
-    return res
+    return ORJSONResponse(posts_list_response(res))
 
 
 @router.get("/user/{id:int}", response_model=PostsListResponse, tags=["posts"])
-async def get_user_posts(id: int, session: AsyncSession = Depends(get_db_session), page: int = Query(1, ge=1),
-                         per_page: int = Query(100, ge=0), credentials=Depends(access_policy)):
-    limit = per_page * page
+async def get_user_posts(id: int, session: AsyncSession = Depends(get_read_db_session), page: int = Query(1, ge=1),
+                         per_page: int = Query(100, ge=0), cursor=Depends(get_cursor),
+                         count_mode=Depends(get_count_mode), credentials=Depends(access_policy)):
+    limit = per_page
     offset = (page - 1) * per_page
-    res = await get_posts_user_id(session, limit, offset, owner_id=id, user_id=credentials.subject['id'])
+    res = await get_posts_user_id(session, limit, offset, owner_id=id, user_id=credentials.subject['id'],
+                                  after=cursor, count_mode=count_mode)
+    like_buffer.overlay(credentials.subject['id'], res['items'])
 
-    return res
+    return ORJSONResponse(posts_list_response(res))
+
+
+@router.get("/search", response_model=PostsListResponse, tags=["posts"])
+async def search(q: str = Query(min_length=1, max_length=256, description="words, \"phrases\", or, -excluded"),
+                 session: AsyncSession = Depends(get_read_db_session), per_page: int = Query(20, ge=0),
+                 cursor=Depends(get_search_cursor), count_mode=Depends(get_count_mode),
+                 credentials=Depends(access_policy)):
+    res = await search_posts(session, q, per_page, user_id=credentials.subject['id'], after=cursor,
+                             count_mode=count_mode)
+    like_buffer.overlay(credentials.subject['id'], res['items'])
+
+    return ORJSONResponse(posts_list_response(res))
 
 
 @router.get("/{id:int}", response_model=PostResponse, tags=["posts"])
-async def get_post(id: int, session: AsyncSession = Depends(get_db_session), credentials=Depends(access_policy)):
+async def get_post(id: int, session: AsyncSession = Depends(get_read_db_session), credentials=Depends(access_policy)):
     res = await get_post_by_id(session, id, credentials.subject['id'])
+    if res is not None:
+        like_buffer.overlay(credentials.subject['id'], [res])
     return res
 
 
-@router.post("/{id:int}/like", tags=['likes'])
-async def like_post(id: int, session: AsyncSession = Depends(get_db_session), credentials=Depends(access_policy)):
-    await set_like(session, credentials.subject['id'], id)
+@router.get("/{id:int}/detail", response_model=PostDetailResponse, tags=["posts"])
+async def get_post_with_comments(id: int, session: AsyncSession = Depends(get_read_db_session),
+                                 comments: int = Query(20, ge=1, le=100, description="comments on the first page"),
+                                 credentials=Depends(access_policy)):
+    res = await get_post_detail(session, id, credentials.subject['id'], comments)
+    if res is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    like_buffer.overlay(credentials.subject['id'], [res])
+
+    return ORJSONResponse(post_detail_response(res))
+
+
+@router.post("/{id:int}/like", tags=['likes'], dependencies=[Depends(like_limit)])
+async def like_post(id: int, session: AsyncSession = Depends(get_user_db_session), credentials=Depends(access_policy)):
+    if like_buffer.enabled:
+        await like_buffer.put(credentials.subject['id'], id, True)
+    else:
+        await set_like(session, credentials.subject['id'], id)
     return 'ok'
 
 
-@router.delete("/{id:int}/like", tags=['likes'])
-async def delete(id: int, session: AsyncSession = Depends(get_db_session), credentials=Depends(access_policy)):
-    await delete_like(session, credentials.subject['id'], id)
+@router.delete("/{id:int}/like", tags=['likes'], dependencies=[Depends(like_limit)])
+async def delete(id: int, session: AsyncSession = Depends(get_user_db_session), credentials=Depends(access_policy)):
+    if like_buffer.enabled:
+        await like_buffer.put(credentials.subject['id'], id, False)
+    else:
+        await delete_like(session, credentials.subject['id'], id)
     return 'ok'
 
 
-@router.post("/{id:int}/comment", response_model=CommentResponse, tags=['comments'])
-async def comment_post(id: int, comment: CommentAdd, session: AsyncSession = Depends(get_db_session),
+@router.post("/{id:int}/comment", response_model=CommentResponse, tags=['comments'],
+             dependencies=[Depends(comment_limit)])
+async def comment_post(id: int, comment: CommentAdd, session: AsyncSession = Depends(get_user_db_session),
                        credentials=Depends(access_policy)):
     return await add_comment(session, credentials.subject['id'], id, comment.text)
 
 
 @router.get("/{id:int}/comments", response_model=CommentListResponse, tags=['comments'])
-async def get_comments_post(id: int, session: AsyncSession = Depends(get_db_session),
+async def get_comments_post(id: int, session: AsyncSession = Depends(get_read_db_session),
                             credentials=Depends(access_policy), page: int = Query(1, ge=1),
-                            per_page: int = Query(100, ge=0)):
-    limit = per_page * page
+                            per_page: int = Query(100, ge=0), cursor=Depends(get_cursor),
+                            count_mode=Depends(get_count_mode)):
+    limit = per_page
     offset = (page - 1) * per_page
-    return await get_comments(session, id, limit, offset)
+    return await get_comments(session, id, limit, offset, after=cursor, count_mode=count_mode)
 
 
 @router.delete("/{id:int}/comment/{comment_id:int}", tags=['comments'])
-async def delete_comment_post(id: int, comment_id: int, session: AsyncSession = Depends(get_db_session),
+async def delete_comment_post(id: int, comment_id: int, session: AsyncSession = Depends(get_user_db_session),
                               credentials=Depends(access_policy)):
     comment = await get_comment_by_id(session, comment_id)
     if comment.user_id != credentials.subject['id']:
@@ -2,8 +2,9 @@ from typing import Optional
 
 from pydantic import BaseModel, Field
 
-from src.api.routers.images.models import ImageResponse
-from src.api.routers.users.models import UserResponse, UserResponseWithoutImages
+from src.api.routers.images.models import ImageResponse, image_response
+from src.api.routers.users.models import UserResponse, UserResponseWithoutImages, user_response
+from src.db.utils import post_to_dict
 
 
 class PostAdd(BaseModel):
@@ -24,8 +25,39 @@ class PostResponse(BaseModel):
 
 
 class PostsListResponse(BaseModel):
-    count: int
+    count: int | None = None
     items: list[PostResponse]
+    has_more: bool = False
+    next_cursor: str | None = None
+
+
+def posts_list_response(res: dict) -> dict:
+    """
+    PostsListResponse of a page from crud as plain data, items are posts or their post_to_dict() form with is_liked.
+    Skips pydantic validation of every nested post, user and image, which dominates big pages
+    """
+    return {'count': res.get('count'), 'items': [post_response(post) for post in res['items']],
+            'has_more': res.get('has_more', False), 'next_cursor': res.get('next_cursor')}
+
+
+def post_response(post) -> dict:
+    """
+    PostResponse of a post or its post_to_dict() form with is_liked as plain data
+    """
+    if not isinstance(post, dict):
+        post = {**post_to_dict(post), 'is_liked': post.is_liked}
+    images = post['images']
+    return {
+        'id': post['id'],
+        'title': post['title'],
+        'text': post['text'],
+        'images': [image_response(image) for image in images] if images is not None else None,
+        'user': user_response(post['user']),
+        'like_count': post['like_count'],
+        'comment_count': post['comment_count'],
+        'is_liked': post.get('is_liked', False),
+    }
+
 
 class CommentResponse(BaseModel):
     id: int
@@ -33,7 +65,24 @@ class CommentResponse(BaseModel):
     user: UserResponse
 
 class CommentListResponse(BaseModel):
-    count: int
+    count: int | None = None
     items: list[CommentResponse]
+    has_more: bool = False
+    next_cursor: str | None = None
+
 class CommentAdd(BaseModel):
-    text: str
\ No newline at end of file
+    text: str
+
+
+class PostDetailResponse(PostResponse):
+    comments: CommentListResponse
+
+
+def post_detail_response(post: dict) -> dict:
+    """
+    PostDetailResponse of crud.get_post_detail() as plain data
+    """
+    comments = post['comments']
+    items = [{'id': comment['id'], 'text': comment['text'], 'user': user_response(comment['user'])}
+             for comment in comments['items']]
+    return {**post_response(post), 'comments': {**comments, 'items': items}}
\ No newline at end of file
@@ -1,9 +1,12 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 
+from src import config
 from src.api.routers.users import models
 from src.api.security import access_policy
-from src.api.sessions import get_db_session
-from src.db.crud import get_user_by_id, update_user
+from src.api.sessions import get_read_db_session, get_user_db_session
+from src.db.crud import update_user, user_loader
+from src.db.utils import user_to_dict
 
 router = APIRouter(
     prefix='/user',
@@ -13,18 +16,35 @@ router = APIRouter(
 
 
 @router.get("/{id:int}", response_model=models.UserResponse)
-async def get_user(id: int, session=Depends(get_db_session)):
-    user = await get_user_by_id(session, id)
+async def get_user(id: int, session=Depends(get_read_db_session)):
+    user = await user_loader(session).load(id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
+@router.get("/batch", response_model=models.UsersBatchResponse)
+async def get_users_batch(ids: str = Query(pattern=r'^\d+(,\d+)*$', description="comma separated user ids"),
+                          session=Depends(get_read_db_session)):
+    """
+    Users in the order of ids, unknown ones are skipped
+    """
+    ids = list(dict.fromkeys(int(id) for id in ids.split(',')))
+    if len(ids) > config.USER_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {config.USER_BATCH_MAX_IDS} ids")
+    users = await user_loader(session).load_many(ids)
+    return ORJSONResponse({'items': [models.user_response(user_to_dict(user)) for user in users if user is not None]})
+
+
 @router.get("/me", response_model=models.UserResponse)
-async def get_me(credentials=Depends(access_policy), session=Depends(get_db_session)):
-    user = await get_user_by_id(session, credentials.subject['id'])
+async def get_me(credentials=Depends(access_policy), session=Depends(get_read_db_session)):
+    user = await user_loader(session).load(credentials.subject['id'])
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
 @router.post("/edit", response_model=models.UserResponse)
-async def edit_user(form: models.UserEdit, session=Depends(get_db_session), credentials=Depends(access_policy)):
+async def edit_user(form: models.UserEdit, session=Depends(get_user_db_session), credentials=Depends(access_policy)):
     return await update_user(session, credentials.subject['id'], name=form.name, about=form.about,
                              img_hash=form.img_hash)
@@ -2,7 +2,7 @@ from typing import Optional
 
 from pydantic import BaseModel
 
-from src.api.routers.images.models import ImageResponse
+from src.api.routers.images.models import ImageResponse, image_response
 
 
 class UserResponse(BaseModel):
@@ -15,6 +15,16 @@ class UserResponse(BaseModel):
         orm_mode = True
 
 
+def user_response(user: dict) -> dict:
+    images = user['images']
+    return {'id': user['id'], 'name': user['name'], 'about': user['about'],
+            'images': [image_response(image) for image in images] if images is not None else None}
+
+
+class UsersBatchResponse(BaseModel):
+    items: list[UserResponse]
+
+
 class UserResponseWithoutImages(BaseModel):
     id: int
     name: str
@@ -1,16 +1,55 @@
+import hashlib
+import time
 from datetime import timedelta
 
-from fastapi_jwt import JwtAccessBearer, JwtRefreshBearer
+from fastapi_jwt import JwtAccessBearer, JwtAuthorizationCredentials, JwtRefreshBearer
+from prometheus_client import Counter
 
 from src import config
+from src.db.cache import MemoryBackend
 
-access_policy = JwtAccessBearer(
+VERIFIED_TOKENS = Counter('jwt_cache_requests_total', 'Lookups in the verified access token cache', ['result'])
+
+
+class CachedJwtAccessBearer(JwtAccessBearer):
+    """
+    Remembers the claims of verified access tokens by a digest of the whole token, so repeated requests of
+    an active client skip the signature check and decoding. FastAPI caches dependencies within a request,
+    so together a token is verified at most once per request and usually once per cache ttl
+    """
+
+    def __init__(self, *args, cache_size: int, cache_ttl: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.verified = MemoryBackend(cache_size, cache_ttl)
+
+    async def _get_credentials(self, bearer, cookie) -> JwtAuthorizationCredentials | None:
+        if not bearer:
+            return await super()._get_credentials(bearer, cookie)
+        key = hashlib.sha256(bearer.credentials.encode()).hexdigest()
+        credentials = await self.verified.get(key)
+        if credentials is not None:
+            VERIFIED_TOKENS.labels('hit').inc()
+            return credentials
+        VERIFIED_TOKENS.labels('miss').inc()
+        payload = await self._get_payload(bearer, cookie)
+        if not payload:
+            return None
+        credentials = JwtAuthorizationCredentials(payload['subject'], payload.get('jti'))
+        ttl = payload['exp'] - time.time()
+        if ttl > 0:
+            await self.verified.set(key, credentials, ttl)
+        return credentials
+
+
+access_policy = CachedJwtAccessBearer(
     secret_key=config.JWT_SECRET_KEY,
     auto_error=True,
-    access_expires_delta=timedelta(hours=2)
+    access_expires_delta=timedelta(hours=2),
+    cache_size=config.JWT_CACHE_SIZE,
+    cache_ttl=config.JWT_CACHE_TTL,
 )
 refresh_policy = JwtRefreshBearer(
     secret_key=config.JWT_SECRET_KEY,
     auto_error=True,
     refresh_expires_delta=timedelta(hours=config.JWT_EXPIRE_HOURS)
-)
\ No newline at end of file
+)
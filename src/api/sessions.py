@@ -1,28 +1,240 @@
-from aioboto3 import Session as AsyncS3Session
-from boto3 import Session as SyncS3Session
-from botocore.client import BaseClient
-from botocore.config import Config
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from fastapi import Depends
+from prometheus_client import Gauge
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
 
 from src import config
+from src.api.metrics import MeteredPool, instrument_engine, instrument_s3_client
+from src.api.security import access_policy
+
+if TYPE_CHECKING:
+    from botocore.client import BaseClient
+
+logger = logging.getLogger(__name__)
+
+REPLICA_HEALTHY = Gauge('db_replica_healthy', 'Whether the replica passed its last health check', ['replica'])
+REPLICA_LAG = Gauge('db_replica_lag_seconds', 'Replication lag seen by the last health check', ['replica'])
+
+
+def make_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, echo=config.SQL_ECHO, pool_size=config.DB_POOL_SIZE, poolclass=MeteredPool)
+    instrument_engine(engine)
+    return engine
 
-engine = create_async_engine(config.DB_URL, echo=True, pool_size=20)
+
+async def prewarm_pool(engine: AsyncEngine, size: int):
+    """
+    Opens size connections of the pool at once, so the first requests after a start don't wait for
+    connecting and the setup of asyncpg on every connection
+    """
+    connections = await asyncio.gather(*(engine.connect() for _ in range(size)), return_exceptions=True)
+    for connection in connections:
+        if isinstance(connection, BaseException):
+            logger.warning("Failed to prewarm connection to %s: %r", engine.url.host, connection)
+        else:
+            await connection.close()
+
+
+engine = make_engine(config.DB_URL)
 async_session: async_sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
 
+# zero when nothing is left to replay, otherwise the age of the last replayed transaction. NULL on a primary
+REPLICA_LAG_QUERY = text("""
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+""")
+
+
+class ReplicaSet:
+    """
+    Read replicas used round-robin among those that passed the last health check, falling back to the
+    primary when none did. Users who committed on the primary within read_after_write seconds keep reading
+    from it, so they see their own writes regardless of the replication lag. With redis_url they are
+    remembered in Redis, so that every worker knows them
+    """
+
+    def __init__(self, urls: list[str], check_interval: int, max_lag: float, read_after_write: int,
+                 redis_url: str | None = None):
+        self.engines = [make_engine(url) for url in urls]
+        self.sessions = [async_sessionmaker(engine, expire_on_commit=False, info={'replica': True})
+                         for engine in self.engines]
+        self.healthy = [False] * len(self.engines)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.read_after_write = read_after_write
+        self.counter = itertools.count()
+        self.writers: OrderedDict[int, float] = OrderedDict()
+        self.redis = None
+        if self.engines and redis_url is not None:
+            from redis import asyncio as aioredis
+
+            self.redis = aioredis.from_url(redis_url)
+        self.task: asyncio.Task | None = None
+
+    async def wrote(self, *user_ids: int):
+        if not self.engines:
+            return
+        now = time.monotonic()
+        for user_id in user_ids:
+            self.writers[user_id] = now + self.read_after_write
+            self.writers.move_to_end(user_id)
+        # all entries live equally long, so the expired ones are at the front
+        while self.writers and next(iter(self.writers.values())) < now:
+            self.writers.popitem(last=False)
+        if self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for user_id in user_ids:
+                        pipe.set(f'writer:{user_id}', 1, ex=self.read_after_write)
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning("Failed to remember writers in Redis, other workers may read stale data: %r", e)
+
+    async def is_writer(self, user_id: int) -> bool:
+        if self.writers.get(user_id, 0) > time.monotonic():
+            return True
+        if self.redis is None:
+            return False
+        try:
+            return bool(await self.redis.exists(f'writer:{user_id}'))
+        except Exception as e:
+            logger.warning("Failed to look up a writer in Redis, reading from the primary: %r", e)
+            return True
+
+    async def session_maker(self, user_id: int | None = None) -> async_sessionmaker:
+        if not self.engines or (user_id is not None and await self.is_writer(user_id)):
+            return async_session
+        healthy = [index for index, ok in enumerate(self.healthy) if ok]
+        if not healthy:
+            return async_session
+        return self.sessions[healthy[next(self.counter) % len(healthy)]]
+
+    async def check(self, index: int):
+        try:
+            async with asyncio.timeout(self.check_interval):
+                async with self.engines[index].connect() as conn:
+                    lag = await conn.scalar(REPLICA_LAG_QUERY) or 0
+        except Exception as e:
+            if self.healthy[index]:
+                logger.warning("Replica %s failed its health check: %r", index, e)
+            self.healthy[index] = False
+        else:
+            REPLICA_LAG.labels(index).set(lag)
+            self.healthy[index] = lag <= self.max_lag
+        REPLICA_HEALTHY.labels(index).set(self.healthy[index])
+
+    async def run(self):
+        while True:
+            await asyncio.gather(*(self.check(index) for index in range(len(self.engines))))
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        if self.engines:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for engine in self.engines:
+            await engine.dispose()
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+def make_replicas() -> ReplicaSet:
+    if config.READ_AFTER_WRITE_BACKEND not in ('memory', 'redis'):
+        raise Exception(f"Unknown READ_AFTER_WRITE_BACKEND {config.READ_AFTER_WRITE_BACKEND}")
+    return ReplicaSet(config.DB_REPLICA_URLS, config.DB_REPLICA_CHECK_SECONDS, config.DB_REPLICA_MAX_LAG,
+                      config.READ_AFTER_WRITE_SECONDS,
+                      config.REDIS_URL if config.READ_AFTER_WRITE_BACKEND == 'redis' else None)
+
+
+replicas = make_replicas()
+
+
+class WriterSession(AsyncSession):
+    """
+    Session of an authorized user, remembers them as a writer once a commit is done and before the response
+    """
+
+    async def commit(self):
+        await super().commit()
+        await replicas.wrote(self.info['user_id'])
+
+
+user_session: async_sessionmaker = async_sessionmaker(engine, expire_on_commit=False, class_=WriterSession)
+
 
 async def get_db_session() -> AsyncSession:
     async with async_session() as session:
         yield session
 
 
-async def get_s3_session_async() -> BaseClient:
-    session = AsyncS3Session()
-    client = session.client('s3', endpoint_url=config.S3_URL, aws_access_key_id=config.S3_ACCESS_KEY,
-                            aws_secret_access_key=config.S3_SECRET_KEY, config=Config(signature_version='s3v4'))
-    return client
+async def get_user_db_session(credentials=Depends(access_policy)) -> AsyncSession:
+    """
+    Primary session of an authorized user, its commits send the user's next reads to the primary as well
+    """
+    async with user_session(info={'user_id': credentials.subject['id']}) as session:
+        yield session
+
+
+async def get_read_db_session(credentials=Depends(access_policy)) -> AsyncSession:
+    async with (await replicas.session_maker(credentials.subject['id']))() as session:
+        yield session
+
+
+class S3Client:
+    """
+    Single client for the application lifetime, so credentials, endpoints and keep-alive connections
+    of its pool are set up once instead of on every request
+    """
+
+    def __init__(self):
+        self.client: 'BaseClient | None' = None
+        self.context = None
+
+    async def start(self):
+        # aioboto3 brings boto3, botocore and aiohttp along, a good part of the import time of the app
+        from aioboto3 import Session as AsyncS3Session
+        from aiobotocore.config import AioConfig
+
+        session = AsyncS3Session()
+        self.context = session.client(
+            's3', endpoint_url=config.S3_URL, aws_access_key_id=config.S3_ACCESS_KEY,
+            aws_secret_access_key=config.S3_SECRET_KEY,
+            config=AioConfig(signature_version='s3v4', max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+                             retries={'max_attempts': config.S3_MAX_ATTEMPTS, 'mode': 'standard'},
+                             tcp_keepalive=True, connector_args={'keepalive_timeout': config.S3_KEEPALIVE_TIMEOUT}))
+        self.client = await self.context.__aenter__()
+        instrument_s3_client(self.client)
+
+    async def prewarm(self):
+        """
+        Opens a keep-alive connection to S3 ahead of the first upload or variant
+        """
+        try:
+            await self.client.head_bucket(Bucket=config.S3_BUCKET)
+        except Exception as e:
+            logger.warning("Failed to prewarm S3 connection: %r", e)
+
+    async def stop(self):
+        if self.context is not None:
+            context, self.context, self.client = self.context, None, None
+            await context.__aexit__(None, None, None)
+
+
+s3_client = S3Client()
+
 
-def get_s3_session_sync() -> BaseClient:
-    session = SyncS3Session()
-    client = session.client('s3', endpoint_url=config.S3_URL, aws_access_key_id=config.S3_ACCESS_KEY,
-                            aws_secret_access_key=config.S3_SECRET_KEY, config=Config(signature_version='s3v4'))
-    return client
+async def get_s3_client() -> 'BaseClient':
+    if s3_client.client is None:
+        raise Exception("S3 client is not started")
+    return s3_client.client
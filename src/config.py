@@ -6,6 +6,19 @@ def required_env(name):
     if value is None:
         raise Exception(f"Environment variable {name} is required")
     return value
+
+
+def sql_echo(value: str) -> bool | str:
+    value = value.strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("0", "false", "no", "off", ""):
+        return False
+    if value == "debug":
+        return "debug"
+    raise Exception(f"SQL_ECHO must be one of 0/1/true/yes/on/false/no/off/debug, got {value!r}")
+
+
 DB_HOST = required_env("DB_HOST")
 DB_USER = required_env("DB_USER")
 DB_PASSWORD = required_env("DB_PASSWORD")
@@ -16,9 +29,107 @@ S3_BUCKET = required_env("S3_BUCKET")
 S3_ACCESS_KEY = required_env("S3_ACCESS_KEY")
 S3_SECRET_KEY = required_env("S3_SECRET_KEY")
 ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg']
+PRESIGNED_URL_EXPIRES = int(os.getenv("PRESIGNED_URL_EXPIRES", "3600"))
+# a cached url is handed out until this many seconds before it expires
+PRESIGNED_URL_MARGIN = int(os.getenv("PRESIGNED_URL_MARGIN", "600"))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "10000"))
+MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", str(20 * 1024 * 1024)))
+S3_MULTIPART_CHUNK_SIZE = int(os.getenv("S3_MULTIPART_CHUNK_SIZE", str(8 * 1024 * 1024)))
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50"))
+S3_KEEPALIVE_TIMEOUT = int(os.getenv("S3_KEEPALIVE_TIMEOUT", "30"))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "3"))
+# widths of WebP copies made for every uploaded image, only those narrower than the original
+IMAGE_VARIANTS = [int(width) for width in os.getenv("IMAGE_VARIANTS", "160,480,1080").split(",") if width]
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "2"))
 
 
 DB_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+# connections every database pool keeps open
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+# connections of every database pool opened at startup, 0 to open them on demand
+DB_POOL_PREWARM = int(os.getenv("DB_POOL_PREWARM", "5"))
+# read replicas as host[:port] with the same credentials and database name, reads of authorized GET endpoints
+# go to them round-robin unless the user committed something within READ_AFTER_WRITE_SECONDS
+DB_REPLICA_HOSTS = [host for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host]
+DB_REPLICA_URLS = [f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{host}/{DB_NAME}" for host in DB_REPLICA_HOSTS]
+DB_REPLICA_CHECK_SECONDS = int(os.getenv("DB_REPLICA_CHECK_SECONDS", "5"))
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+READ_AFTER_WRITE_SECONDS = int(os.getenv("READ_AFTER_WRITE_SECONDS", "10"))
+# where users who just wrote are remembered: "memory" of each worker, enough for a single one, or "redis" at
+# REDIS_URL, needed with several workers since the read after a write usually lands on another worker
+READ_AFTER_WRITE_BACKEND = os.getenv("READ_AFTER_WRITE_BACKEND", "memory")
+# "1" logs every statement, "debug" also result rows. Can be turned on at runtime through the
+# sqlalchemy.engine logger as well
+SQL_ECHO = sql_echo(os.getenv("SQL_ECHO", "0"))
 JWT_SECRET_KEY = required_env("JWT_SECRET_KEY")
 JWT_EXPIRE_HOURS = 24 * 30 # 30 days
+# verified access tokens remembered per worker, an entry never outlives the exp of its token
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+JWT_CACHE_TTL = int(os.getenv("JWT_CACHE_TTL", "300"))
+
+# admission control: requests in progress of all routes taking a database session together, by default as many as
+# the database pool has connections, and of every route, by default half of that, or of some routes as
+# "/image/upload=4,/post/latests=10" with route paths as in the metrics. Up to ADMISSION_QUEUE_SIZE more wait for a slot at most ADMISSION_QUEUE_TIMEOUT_MS, the
+# rest get 503. A limit of 0 turns that limit off
+ADMISSION_LIMIT = int(os.getenv("ADMISSION_LIMIT", str(DB_POOL_SIZE)))
+ADMISSION_ROUTE_LIMIT = int(os.getenv("ADMISSION_ROUTE_LIMIT", str(DB_POOL_SIZE // 2)))
+ADMISSION_ROUTE_LIMITS = {route: int(limit) for route, limit in
+                          (item.rsplit("=", 1) for item in os.getenv("ADMISSION_ROUTE_LIMITS", "").split(",") if item)}
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_QUEUE_TIMEOUT_MS = int(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "2000"))
+# per user token buckets of write endpoints in each worker: requests per second and burst, a rate of 0 turns one off
+LIKE_RATE = float(os.getenv("LIKE_RATE", "5"))
+LIKE_BURST = int(os.getenv("LIKE_BURST", "20"))
+POST_ADD_RATE = float(os.getenv("POST_ADD_RATE", "0.2"))
+POST_ADD_BURST = int(os.getenv("POST_ADD_BURST", "5"))
+COMMENT_RATE = float(os.getenv("COMMENT_RATE", "1"))
+COMMENT_BURST = int(os.getenv("COMMENT_BURST", "10"))
+IMAGE_UPLOAD_RATE = float(os.getenv("IMAGE_UPLOAD_RATE", "0.5"))
+IMAGE_UPLOAD_BURST = int(os.getenv("IMAGE_UPLOAD_BURST", "10"))
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+# /post/recommended: score = C * likes + X * comments - F * seconds since publication
+POST_SCORE_C = float(os.getenv("POST_SCORE_C", "1.5"))
+POST_SCORE_X = float(os.getenv("POST_SCORE_X", "1.5"))
+POST_SCORE_F = float(os.getenv("POST_SCORE_F", "0.0003"))
+POST_SCORE_REFRESH_SECONDS = int(os.getenv("POST_SCORE_REFRESH_SECONDS", "600"))
+
+# ids accepted by one /user/batch request
+USER_BATCH_MAX_IDS = int(os.getenv("USER_BATCH_MAX_IDS", "100"))
+
+# /post/search: rank of a post found by one of its comments relative to a match of the post itself
+SEARCH_COMMENT_WEIGHT = float(os.getenv("SEARCH_COMMENT_WEIGHT", "0.5"))
+# posts and comments ranked per query, the newest matches. Bounds the cost of a word found almost everywhere
+SEARCH_MAX_MATCHES = int(os.getenv("SEARCH_MAX_MATCHES", "1000"))
+
+# background jobs: API processes work on the queues too unless JOB_WORKER_IN_API=0, then only
+# `python -m src.manage worker` does. A failed job is retried JOB_MAX_ATTEMPTS times in all with backoff doubling
+# from JOB_RETRY_BASE_SECONDS up to JOB_RETRY_MAX_SECONDS. Workers renew the lease of running jobs, one whose lease
+# wasn't renewed for JOB_LEASE_SECONDS lost its worker and is taken again, or failed if that was its last attempt
+JOB_WORKER_IN_API = os.getenv("JOB_WORKER_IN_API", "1") == "1"
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "10"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "3600"))
+
+# first pages of /post/latests and /post/recommended, backend is one of memory, redis, none
+FEED_CACHE_BACKEND = os.getenv("FEED_CACHE_BACKEND", "memory")
+FEED_CACHE_PAGES = int(os.getenv("FEED_CACHE_PAGES", "3"))
+FEED_CACHE_MAX_ENTRIES = int(os.getenv("FEED_CACHE_MAX_ENTRIES", "256"))
+FEED_CACHE_TTL = int(os.getenv("FEED_CACHE_TTL", "60"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# likes/unlikes: off writes each one in its own transaction, wait batches them and answers after the batch
+# is committed, async answers right away and may lose the last window of likes if the process dies
+LIKE_BUFFER_MODE = os.getenv("LIKE_BUFFER_MODE", "off")
+LIKE_BUFFER_WINDOW_MS = int(os.getenv("LIKE_BUFFER_WINDOW_MS", "200"))
+LIKE_BUFFER_MAX_SIZE = int(os.getenv("LIKE_BUFFER_MAX_SIZE", "1000"))
+# in async mode a like is dropped after this many failed flushes instead of being retried forever
+LIKE_BUFFER_MAX_FAILURES = int(os.getenv("LIKE_BUFFER_MAX_FAILURES", "5"))
 
@@ -0,0 +1,127 @@
+import json
+import math
+import time
+from collections import OrderedDict
+from typing import Any
+
+from src import config
+
+
+class MemoryBackend:
+    """
+    LRU of a single process, enough when the API runs in one worker. Values are kept as is, clear() starts
+    a new generation
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.generation = 0
+
+    async def get(self, key: str) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def get_generation(self) -> int:
+        return self.generation
+
+    async def set(self, key: str, value: Any, ttl: float | None = None, generation: int | None = None):
+        """
+        Stores nothing if generation is given and clear() was called since it was taken
+        """
+        if generation is not None and generation != self.generation:
+            return
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl)), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def delete(self, key: str):
+        self.entries.pop(key, None)
+
+    async def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+
+class RedisBackend:
+    """
+    Shared between workers. Keys are prefixed with a generation which clear() increments, so invalidation
+    is a single INCR and entries of old generations go away by ttl or by the server's allkeys-lru eviction
+    """
+
+    def __init__(self, url: str, ttl: int, prefix: str = 'feed'):
+        from redis import asyncio as aioredis
+
+        self.redis = aioredis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get_generation(self) -> int:
+        return int(await self.redis.get(f'{self.prefix}:generation') or 0)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.redis.get(f'{self.prefix}:{await self.get_generation()}:{key}')
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None, generation: int | None = None):
+        """
+        With generation the value goes under that generation, where nobody reads anymore once it is cleared
+        """
+        if generation is None:
+            generation = await self.get_generation()
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        await self.redis.set(f'{self.prefix}:{generation}:{key}', value, ex=max(1, math.ceil(ttl)))
+
+    async def clear(self):
+        await self.redis.incr(f'{self.prefix}:generation')
+
+
+class FeedCache:
+    """
+    Holds the user independent part of the first pages of post feeds
+    """
+
+    def __init__(self, backend: MemoryBackend | RedisBackend | None, pages: int):
+        self.backend = backend
+        self.pages = pages
+
+    def covers(self, limit: int, offset: int, after=None) -> bool:
+        return self.backend is not None and after is None and offset < self.pages * limit
+
+    async def get(self, key: str) -> dict | None:
+        value = await self.backend.get(key)
+        return json.loads(value) if value is not None else None
+
+    async def generation(self) -> int:
+        return await self.backend.get_generation()
+
+    async def set(self, key: str, page: dict, generation: int, ttl: float | None = None):
+        """
+        Caches a page loaded after generation was taken, unless invalidate() was called since
+        """
+        await self.backend.set(key, json.dumps(page).encode(), ttl, generation)
+
+    async def invalidate(self):
+        if self.backend is not None:
+            await self.backend.clear()
+
+
+def make_backend():
+    if config.FEED_CACHE_BACKEND == 'memory':
+        return MemoryBackend(config.FEED_CACHE_MAX_ENTRIES, config.FEED_CACHE_TTL)
+    if config.FEED_CACHE_BACKEND == 'redis':
+        return RedisBackend(config.REDIS_URL, config.FEED_CACHE_TTL)
+    if config.FEED_CACHE_BACKEND == 'none':
+        return None
+    raise Exception(f"Unknown FEED_CACHE_BACKEND {config.FEED_CACHE_BACKEND}")
+
+
+feed_cache = FeedCache(make_backend(), config.FEED_CACHE_PAGES)
@@ -1,27 +1,257 @@
-from sqlalchemy import select, delete, func, Select, text, desc
-from sqlalchemy.dialects.postgresql import insert
+import asyncio
+import datetime
+import json
+from collections import Counter
+
+from sqlalchemy import select, delete, update, func, Select, text, tuple_, literal, ColumnElement, values, \
+    column, Integer, Double, cast, union_all, any_, exists, JSON, and_, case
+from sqlalchemy.dialects.postgresql import insert, REGCONFIG, ARRAY, aggregate_order_by
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, with_expression, joinedload, aliased
+
+from src import config
+from src.db.cache import feed_cache
+from src.db.schemas import User, Post, Image, Like, Comment, Job, image_post_table, image_user_table, SEARCH_CONFIG
+from src.db.utils import post_options, encode_cursor, encode_search_cursor, post_score, post_to_dict, CountMode
+
+
+async def estimate_rows(session: AsyncSession, query: Select) -> int:
+    """
+    Number of rows the planner expects query to return, costs a planning of the query instead of running it
+    """
+    # bound like the query itself would be, values aren't spliced into the SQL
+    compiled = query.compile(dialect=session.bind.dialect)
+    params = compiled.construct_params()
+    processors = compiled._bind_processors
+    parameters = tuple(processors[name](params[name]) if name in processors else params[name]
+                       for name in compiled.positiontup)
+    connection = await session.connection()
+    plan = (await connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', parameters)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+async def count_rows(session: AsyncSession, query: Select, count_mode: CountMode,
+                     estimate: Select | None = None) -> int | None:
+    """
+    Total for a paginated response. `estimate` replaces the planner's estimate by a maintained counter
+    """
+    query = query.order_by(None)
+    if count_mode == CountMode.exact:
+        return await session.scalar(select(func.count()).select_from(query.subquery()))
+    if count_mode == CountMode.estimated:
+        if estimate is not None:
+            return await session.scalar(estimate)
+        return await estimate_rows(session, query)
+    return None
+
+
+async def paginate(session: AsyncSession, query: Select, limit: int, offset: int,
+                   count_mode: CountMode = CountMode.exact, estimate: Select | None = None) -> dict:
+    items = [record for record in await session.scalars(query.limit(limit + 1).offset(offset))]
+    return {
+        'count': await count_rows(session, query, count_mode, estimate),
+        'items': items[:limit],
+        'has_more': len(items) > limit
+    }
+
 
-from src.db.schemas import User, Post, Image, Like, Comment
-from src.db.utils import post_options
+async def paginate_keyset(session: AsyncSession, query: Select, limit: int, offset: int,
+                          after: tuple[datetime.datetime, int] | None, created_time: ColumnElement,
+                          id: ColumnElement, descending: bool = True, count_mode: CountMode = CountMode.exact,
+                          estimate: Select | None = None) -> dict:
+    """
+    Paginates over (created_time, id). With `after` the page starts right behind that key, so a page
+    costs the same at any depth; without it falls back to the legacy offset pagination.
+    """
+    count = await count_rows(session, query, count_mode, estimate)
+    if descending:
+        query = query.order_by(created_time.desc(), id.desc())
+    else:
+        query = query.order_by(created_time.asc(), id.asc())
+    if after is not None:
+        key = tuple_(literal(after[0], created_time.type), literal(after[1], id.type))
+        query = query.where(tuple_(created_time, id) < key if descending else tuple_(created_time, id) > key)
+        offset = 0
+
+    res = await paginate(session, query, limit, offset, CountMode.none)
+    res['count'] = count
+    last = res['items'][-1] if res['items'] else None
+    res['next_cursor'] = encode_cursor(last.created_time, last.id) if res['has_more'] and last else None
+    return res
 
 
-async def paginate(session: AsyncSession, query: Select, limit: int, offset: int) -> dict:
-    return {
-        'count': await session.scalar(select(func.count()).select_from(query.subquery())),
-        'items': [record for record in await session.scalars(query.limit(limit).offset(offset))]
-    }
+async def get_liked_post_ids(session: AsyncSession, user_id: int, post_ids: list[int]) -> set[int]:
+    stmt = select(Like.post_id).where(Like.user_id == user_id, Like.post_id.in_(post_ids))
+    return set(await session.scalars(stmt))
+
+
+async def cached_posts_page(session: AsyncSession, key: str, user_id: int, load) -> dict:
+    """
+    Returns the page of posts from feed_cache or caches the result of load(), then overlays is_liked of the user.
+    A page loaded before the last invalidation isn't cached. One read from a replica may miss writes as old as
+    the replica's lag, so it is cached for at most DB_REPLICA_MAX_LAG seconds
+    """
+    page = await feed_cache.get(key)
+    if page is None:
+        generation = await feed_cache.generation()
+        res = await load()
+        page = {**res, 'items': [post_to_dict(post) for post in res['items']]}
+        ttl = config.DB_REPLICA_MAX_LAG if session.info.get('replica') else None
+        await feed_cache.set(key, page, generation, ttl)
+    liked = await get_liked_post_ids(session, user_id, [post['id'] for post in page['items']])
+    for post in page['items']:
+        post['is_liked'] = post['id'] in liked
+    return page
 
 
 # images:
 async def add_image(session: AsyncSession, user_id: int, hash: str, width: int, height: int) -> Image:
-    image = Image(hash=hash, width=width, height=height, created_by=user_id)
-    session.add(image)
+    """
+    Inserts the image or brings back a deleted one with the same content
+    """
+    stmt = (insert(Image).values(hash=hash, width=width, height=height, created_by=user_id)
+            .on_conflict_do_update(index_elements=[Image.hash],
+                                   set_={'is_deleted': 0, 'variant_widths': None, 'created_by': user_id,
+                                         'orphaned_time': func.now()},
+                                   where=Image.is_deleted == 1)
+            .returning(Image).execution_options(populate_existing=True))
+    image = await session.scalar(stmt)
+    if image is None:  # the same content was uploaded concurrently or gc-images is deleting it
+        image = await get_image_by_hash(session, hash)
     await session.commit()
     return image
 
 
+async def get_image_by_hash(session: AsyncSession, hash: str) -> Image | None:
+    return await session.scalar(select(Image).where(Image.hash == hash))
+
+
+async def reuse_image(session: AsyncSession, hashes: list[str]) -> Image | None:
+    """
+    Oldest live image of hashes, the keys of the same content, for another upload of it, otherwise one gc-images
+    is deleting (is_deleted = 2). An unreferenced live one starts its grace period again, so that gc-images doesn't
+    delete it right after the client got its hash
+    """
+    image = await session.scalar(select(Image).where(Image.hash.in_(hashes), Image.is_deleted != 1)
+                                 .order_by(Image.is_deleted, Image.id).limit(1))
+    if image is None or image.is_deleted or image.ref_count > 0:
+        return image
+    # waits for gc-images if it is marking the image right now and then finds it being deleted
+    stmt = (update(Image).where(Image.id == image.id, Image.is_deleted == 0)
+            .values(orphaned_time=case((Image.ref_count == 0, func.now()), else_=Image.orphaned_time),
+                    modified_time=Image.modified_time)
+            .returning(Image).execution_options(populate_existing=True))
+    reused = await session.scalar(stmt)
+    if reused is None:
+        reused = await session.get(Image, image.id, populate_existing=True)
+    await session.commit()
+    return reused
+
+
+async def shift_image_refs(session: AsyncSession, image_ids: list[int], delta: int):
+    if image_ids:
+        await session.execute(update(Image).where(Image.id.in_(image_ids))
+                              .values(ref_count=Image.ref_count + delta,
+                                      orphaned_time=orphaned_time(Image.ref_count + delta),
+                                      modified_time=Image.modified_time))
+
+
+def orphaned_time(ref_count: ColumnElement) -> ColumnElement:
+    return case((ref_count > 0, None), else_=func.coalesce(Image.orphaned_time, func.now()))
+
+
+async def get_linkable_images(session: AsyncSession, hashes: list[str]) -> list[Image]:
+    """
+    Live images by hash, locked until commit so that gc-images skips them while they are being linked
+    """
+    stmt = select(Image).where(Image.hash.in_(hashes), Image.is_deleted == 0).with_for_update(key_share=True)
+    return list(await session.scalars(stmt))
+
+
+async def repair_image_refs(session: AsyncSession) -> int:
+    """
+    Recomputes ref_count of images from post_image and user_image, returns number of fixed images
+    """
+    refs = (select(func.count()).select_from(image_post_table).where(image_post_table.c.image_id == Image.id)
+            .scalar_subquery()
+            + select(func.count()).select_from(image_user_table).where(image_user_table.c.image_id == Image.id)
+            .scalar_subquery())
+    stmt = (update(Image).where((Image.ref_count != refs) | ((refs == 0) != Image.orphaned_time.isnot(None)))
+            .values(ref_count=refs, orphaned_time=orphaned_time(refs), modified_time=Image.modified_time)
+            .execution_options(synchronize_session=False))
+    res = await session.execute(stmt)
+    await session.commit()
+    return res.rowcount
+
+
+async def set_image_variants(session: AsyncSession, hash: str, variant_widths: list[int]):
+    await session.execute(update(Image).where(Image.hash == hash).values(variant_widths=variant_widths))
+    await session.commit()
+
+
+async def get_images_without_variants(session: AsyncSession, limit: int, after_id: int = 0) -> list[Image]:
+    stmt = (select(Image).where(Image.variant_widths.is_(None), Image.is_deleted == 0, Image.id > after_id)
+            .order_by(Image.id).limit(limit))
+    return list(await session.scalars(stmt))
+
+
+def orphaned(grace_seconds: float) -> ColumnElement:
+    # the anti-join protects images whose ref_count is off, until repair-counters fixes it
+    return and_(Image.is_deleted == 0, Image.ref_count == 0,
+                Image.orphaned_time < func.now() - datetime.timedelta(seconds=grace_seconds),
+                ~exists().where(image_post_table.c.image_id == Image.id),
+                ~exists().where(image_user_table.c.image_id == Image.id))
+
+
+async def get_orphaned_images(session: AsyncSession, grace_seconds: float, limit: int,
+                              after: tuple[datetime.datetime, int] | None = None) -> list[Image]:
+    stmt = select(Image).where(orphaned(grace_seconds)).order_by(Image.orphaned_time, Image.id).limit(limit)
+    if after is not None:
+        stmt = stmt.where(tuple_(Image.orphaned_time, Image.id) > after)
+    return list(await session.scalars(stmt))
+
+
+async def mark_orphaned_images(session: AsyncSession, grace_seconds: float, limit: int) -> list[Image]:
+    """
+    Marks up to limit images unreferenced for grace_seconds as being deleted (is_deleted = 2) and returns them.
+    Images being linked right now are locked by get_linkable_images and skipped
+    """
+    due = (select(Image.id).where(orphaned(grace_seconds)).order_by(Image.orphaned_time, Image.id).limit(limit)
+           .with_for_update(skip_locked=True).scalar_subquery())
+    stmt = (update(Image).where(Image.id.in_(due)).values(is_deleted=2, modified_time=Image.modified_time)
+            .returning(Image).execution_options(synchronize_session=False))
+    images = list(await session.scalars(stmt))
+    await session.commit()
+    return images
+
+
+async def get_images_being_deleted(session: AsyncSession, limit: int, after_id: int = 0) -> list[Image]:
+    stmt = select(Image).where(Image.is_deleted == 2, Image.id > after_id).order_by(Image.id).limit(limit)
+    return list(await session.scalars(stmt))
+
+
+async def set_images_deleted(session: AsyncSession, image_ids: list[int]):
+    await session.execute(update(Image).where(Image.id.in_(image_ids), Image.is_deleted == 2)
+                          .values(is_deleted=1, modified_time=Image.modified_time)
+                          .execution_options(synchronize_session=False))
+    await session.commit()
+
+
+async def notify_deleted_objects(session: AsyncSession, channel: str, keys: list[str]):
+    """
+    Tells the listeners of channel which storage keys are gone, on commit. Keys go in chunks, a NOTIFY payload
+    is limited to 8000 bytes
+    """
+    for start in range(0, len(keys), 50):
+        await session.execute(select(func.pg_notify(channel, ','.join(keys[start:start + 50]))))
+
+
+async def get_live_image_hashes(session: AsyncSession, hashes: list[str]) -> set[str]:
+    return set(await session.scalars(select(Image.hash).where(Image.hash.in_(hashes), Image.is_deleted == 0)))
+
+
 # users:
 async def add_user(session: AsyncSession, login: str, name: str, password: str) -> User:
     user = User(login=login, name=name, password=password)
@@ -38,12 +268,20 @@ async def update_user(session: AsyncSession, id: int, name: str | None = None,
     if about is not None:
         user.about = about
     if img_hash is not None:
-        img = await session.execute(select(Image).where(Image.hash == img_hash))
-        user.images = img.scalars().all()
+        images = await get_linkable_images(session, [img_hash])
+        old_ids, new_ids = {image.id for image in user.images}, {image.id for image in images}
+        await shift_image_refs(session, list(old_ids - new_ids), -1)
+        await shift_image_refs(session, list(new_ids - old_ids), 1)
+        user.images = images
     await session.commit()
     return user
 
 
+async def update_user_password(session: AsyncSession, id: int, password: str):
+    await session.execute(update(User).where(User.id == id).values(password=password))
+    await session.commit()
+
+
 async def get_users(session: AsyncSession, limit, offset):
     stmt = select(User).where(User.is_deleted == 0).options(selectinload(User.images))
     res = await paginate(session, stmt, limit, offset)
@@ -56,6 +294,55 @@ async def get_user_by_id(session: AsyncSession, id: int):
     return user
 
 
+class UserLoader:
+    """
+    Coalesces the lookups of users by id issued within one event loop tick into a single query, a user comes
+    with its images from the same round trip. Ids asked for while a batch loads go into the next one, so the
+    session runs one query at a time. Every id is looked up once for the life of the loader, get one per session
+    with user_loader()
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.users: dict[int, asyncio.Future] = {}
+        self.pending: list[int] = []
+        self.dispatcher: asyncio.Task | None = None
+
+    async def load(self, id: int) -> User | None:
+        future = self.users.get(id)
+        if future is None:
+            future = self.users[id] = asyncio.get_running_loop().create_future()
+            self.pending.append(id)
+            if self.dispatcher is None or self.dispatcher.done():
+                self.dispatcher = asyncio.create_task(self.dispatch())
+        return await future
+
+    async def load_many(self, ids: list[int]) -> list[User | None]:
+        return list(await asyncio.gather(*(self.load(id) for id in ids)))
+
+    async def dispatch(self):
+        # one more tick, for the tasks that the ones scheduled alongside start, e.g. by a nested gather
+        await asyncio.sleep(0)
+        while self.pending:
+            ids, self.pending = self.pending, []
+            stmt = select(User).where(User.id == any_(literal(ids, ARRAY(Integer)))).options(joinedload(User.images))
+            try:
+                users = {user.id: user for user in (await self.session.scalars(stmt)).unique()}
+            except Exception as e:
+                # forgotten, so a later load() tries again
+                for id in ids:
+                    self.users.pop(id).set_exception(e)
+                continue
+            for id in ids:
+                self.users[id].set_result(users.get(id))
+
+
+def user_loader(session: AsyncSession) -> UserLoader:
+    if 'user_loader' not in session.info:
+        session.info['user_loader'] = UserLoader(session)
+    return session.info['user_loader']
+
+
 async def get_user_by_login(session: AsyncSession, login: str):
     stmt = select(User).where(User.login == login)
     user = await session.scalar(stmt)
@@ -67,61 +354,173 @@ async def get_user_by_login(session: AsyncSession, login: str):
 
 async def add_post(session: AsyncSession, user_id: int, title: str = "",
                    text: str = "", images_hash=[]) -> Post:
-    images = await session.execute(select(Image).where(Image.hash.in_(images_hash)))
+    images = await get_linkable_images(session, images_hash)
     user = await get_user_by_id(session, user_id)
-    images = images.scalars().all()
     post = Post(
         title=title,
         text=text,
         user=user,
-        images=images
+        images=images,
+        like_count=0,
+        comment_count=0,
+        # created_time is a timestamp without time zone, func.now() would differ from it by the utc offset
+        score=post_score(0, 0, func.localtimestamp())
     )
     session.add(post)
+    await shift_image_refs(session, [image.id for image in images], 1)
     await session.commit()
+    await feed_cache.invalidate()
     post.is_liked = False
-    post.like_count = 0
-    post.comment_count = 0
     return post
 
 
 async def get_post_by_id(session: AsyncSession, id: int, user_id: int):
-    stmt = select(Post).join(Comment, isouter=True).join(Like, isouter=True).where(Post.id == id).options(
-        *post_options(user_id)
-    ).group_by(Post.id)
+    stmt = select(Post).where(Post.id == id).options(*post_options(user_id))
+    post = await session.scalar(stmt)
+    return post
+
+
+def images_json(link_table, owner: ColumnElement, owner_id: ColumnElement) -> ColumnElement:
+    """
+    JSON array of image_to_dict() of the images linked through link_table, whose owner column is owner_id
+    """
+    image = func.json_build_object('hash', Image.hash, 'width', Image.width, 'height', Image.height,
+                                   'variant_widths', Image.variant_widths)
+    return (select(func.coalesce(func.json_agg(aggregate_order_by(image, Image.id)), text("'[]'::json")))
+            .select_from(link_table.join(Image, Image.id == link_table.c.image_id))
+            .where(owner == owner_id).scalar_subquery())
+
+
+def user_json(user) -> ColumnElement:
+    """
+    JSON of user_to_dict() of the user row
+    """
+    return func.json_build_object('id', user.id, 'name', user.name, 'about', user.about,
+                                  'images', images_json(image_user_table, image_user_table.c.user_id, user.id))
+
+
+async def get_post_detail(session: AsyncSession, id: int, user_id: int, comments: int) -> dict | None:
+    """
+    post_to_dict() of the post with is_liked of the user and under 'comments' the first page of its comments
+    as get_comments pages them, built by Postgres as one JSON value in a single statement instead of the
+    several selects of get_post_by_id and get_comments. Comments carry created_time for the cursor
+    """
+    author, commenter = aliased(User), aliased(User)
+    page = (select(Comment.id, Comment.text, Comment.user_id, Comment.created_time)
+            .where(Comment.post_id == Post.id, Comment.is_deleted == 0)
+            .order_by(Comment.created_time, Comment.id).limit(comments + 1).correlate(Post).subquery())
+    comment = func.json_build_object('id', page.c.id, 'text', page.c.text, 'created_time', page.c.created_time,
+                                     'user', user_json(commenter))
+    comments_json = (select(func.coalesce(func.json_agg(aggregate_order_by(comment, page.c.created_time,
+                                                                            page.c.id)), text("'[]'::json")))
+                     .select_from(page.join(commenter, commenter.id == page.c.user_id)).scalar_subquery())
+    stmt = (
+        select(func.json_build_object(
+            'id', Post.id, 'title', Post.title, 'text', Post.text,
+            'images', images_json(image_post_table, image_post_table.c.post_id, Post.id), 'user', user_json(author),
+            'like_count', Post.like_count, 'comment_count', Post.comment_count,
+            'is_liked', exists().where(Like.post_id == Post.id, Like.user_id == user_id),
+            'comments', comments_json, type_=JSON))
+        .select_from(Post).join(author, author.id == Post.user_id).where(Post.id == id)
+    )
     post = await session.scalar(stmt)
+    if post is None:
+        return None
+    items = post['comments']
+    last = items[comments - 1] if len(items) > comments else None
+    post['comments'] = {
+        'count': post['comment_count'],
+        'items': items[:comments],
+        'has_more': last is not None,
+        'next_cursor': encode_cursor(datetime.datetime.fromisoformat(last['created_time']), last['id'])
+        if last else None,
+    }
     return post
 
 
-async def get_posts(session: AsyncSession, limit, offset, user_id: int):
+async def get_posts(session: AsyncSession, limit, offset, user_id: int, after=None,
+                    count_mode: CountMode = CountMode.exact):
+    if feed_cache.covers(limit, offset, after):
+        return await cached_posts_page(session, f'latests:{limit}:{offset}:{count_mode.value}', user_id,
+                                       lambda: _get_posts(session, limit, offset, None, after, count_mode))
+    return await _get_posts(session, limit, offset, user_id, after, count_mode)
+
+
+async def _get_posts(session: AsyncSession, limit, offset, user_id: int | None, after, count_mode: CountMode):
     stmt = (
-        select(Post).join(Comment, isouter=True).join(Like, isouter=True)
+        select(Post)
         .options(*post_options(user_id)).where(Post.is_deleted == 0)
-        .group_by(Post.id)
-        .order_by(Post.created_time.desc())
     )
-    res = await paginate(session, stmt, limit, offset)
+    res = await paginate_keyset(session, stmt, limit, offset, after, Post.created_time, Post.id,
+                                count_mode=count_mode)
     return res
 
 
-async def get_most_liked_posts(session: AsyncSession, limit, offset, user_id: int):
+async def get_most_liked_posts(session: AsyncSession, limit, offset, user_id: int,
+                               count_mode: CountMode = CountMode.exact):
+    if feed_cache.covers(limit, offset):
+        return await cached_posts_page(session, f'recommended:{limit}:{offset}:{count_mode.value}', user_id,
+                                       lambda: _get_most_liked_posts(session, limit, offset, None, count_mode))
+    return await _get_most_liked_posts(session, limit, offset, user_id, count_mode)
+
+
+async def _get_most_liked_posts(session: AsyncSession, limit, offset, user_id: int | None, count_mode: CountMode):
     stmt = (
-        select(Post).join(Comment, isouter=True).join(Like, isouter=True)
+        select(Post)
         .options(*post_options(user_id)).where(Post.is_deleted == 0,
                                                Post.created_time >= text("NOW() - INTERVAL '7 DAY'"))
-        .group_by(Post.id)
-        .order_by(desc(func.calculate_post_score(Post.id, 1.5, 1.5, 0.0003))))
-    res = await paginate(session, stmt, limit, offset)
+        .order_by(Post.score.desc(), Post.id.desc()))
+    res = await paginate(session, stmt, limit, offset, count_mode)
     return res
 
 
-async def get_posts_user_id(session: AsyncSession, limit, offset, owner_id: int, user_id):
+async def get_posts_user_id(session: AsyncSession, limit, offset, owner_id: int, user_id, after=None,
+                            count_mode: CountMode = CountMode.exact):
     stmt = (
-        select(Post).join(Comment, isouter=True).join(Like, isouter=True)
+        select(Post)
         .options(*post_options(user_id)).where(Post.is_deleted == 0, Post.user_id == owner_id)
-        .group_by(Post.id)
-        .order_by(Post.created_time.desc())
     )
-    res = await paginate(session, stmt, limit, offset)
+    res = await paginate_keyset(session, stmt, limit, offset, after, Post.created_time, Post.id,
+                                count_mode=count_mode)
+    return res
+
+
+async def search_posts(session: AsyncSession, query: str, limit, user_id: int, after=None,
+                       count_mode: CountMode = CountMode.exact):
+    """
+    Live posts matching query in websearch syntax by their title, text or live comments, best first. A post
+    ranks by its best match, matches of comments weighted by SEARCH_COMMENT_WEIGHT, among the newest
+    SEARCH_MAX_MATCHES matching posts and comments. Pages follow (rank, id) from `after`, see encode_search_cursor
+    """
+    # a generic plan of this prepared statement, picked after a few common words, scans everything for a rare one
+    await session.execute(text('SET LOCAL plan_cache_mode = force_custom_plan'))
+    tsquery = func.websearch_to_tsquery(cast(literal(SEARCH_CONFIG), REGCONFIG), query)
+    # ranking reads the vector of every match, the limit keeps a word found almost everywhere cheap
+    posts = (select(Post.id.label('post_id'), Post.search_vector.label('search_vector'), literal(1.0).label('weight'))
+             .where(Post.search_vector.bool_op('@@')(tsquery), Post.is_deleted == 0)
+             .order_by(Post.id.desc()).limit(config.SEARCH_MAX_MATCHES))
+    comments = (select(Comment.post_id, Comment.search_vector, literal(config.SEARCH_COMMENT_WEIGHT))
+                .where(Comment.search_vector.bool_op('@@')(tsquery), Comment.is_deleted == 0)
+                .order_by(Comment.id.desc()).limit(config.SEARCH_MAX_MATCHES))
+    matches = union_all(posts, comments).subquery()
+    # double precision, so the rank in a cursor compares equal to the one computed for the next page
+    ranked = (select(matches.c.post_id,
+                     cast(func.max(func.ts_rank(matches.c.search_vector, tsquery) * matches.c.weight), Double)
+                     .label('rank'))
+              .group_by(matches.c.post_id).subquery())
+    stmt = (
+        select(Post).join(ranked, ranked.c.post_id == Post.id)
+        .options(*post_options(user_id), with_expression(Post.search_rank, ranked.c.rank))
+        .where(Post.is_deleted == 0)
+    )
+    count = await count_rows(session, stmt, count_mode)
+    stmt = stmt.order_by(ranked.c.rank.desc(), Post.id.desc())
+    if after is not None:
+        stmt = stmt.where(tuple_(ranked.c.rank, Post.id) < tuple_(literal(after[0], Double), literal(after[1])))
+    res = await paginate(session, stmt, limit, 0, CountMode.none)
+    res['count'] = count
+    last = res['items'][-1] if res['items'] else None
+    res['next_cursor'] = encode_search_cursor(last.search_rank, last.id) if res['has_more'] and last else None
     return res
 
 
@@ -135,17 +534,117 @@ async def get_posts_user_id(session: AsyncSession, limit, offset, owner_id: int,
 #     await session.commit()
 
 
+async def shift_post_counters(session: AsyncSession, post_id: int, likes: int = 0, comments: int = 0):
+    # modified_time is set explicitly so that a new like doesn't look like an edit of the post
+    stmt = update(Post).where(Post.id == post_id).values(
+        like_count=Post.like_count + likes,
+        comment_count=Post.comment_count + comments,
+        score=Post.score + config.POST_SCORE_C * likes + config.POST_SCORE_X * comments,
+        modified_time=Post.modified_time
+    )
+    await session.execute(stmt)
+
+
+async def repair_post_counters(session: AsyncSession) -> int:
+    """
+    Recomputes like_count and comment_count from the like and comment tables, returns number of fixed posts
+    """
+    likes = select(func.count(Like.id)).where(Like.post_id == Post.id).scalar_subquery()
+    comments = select(func.count(Comment.id)).where(Comment.post_id == Post.id,
+                                                    Comment.is_deleted == 0).scalar_subquery()
+    stmt = (update(Post).where((Post.like_count != likes) | (Post.comment_count != comments))
+            .values(like_count=likes, comment_count=comments, modified_time=Post.modified_time)
+            .execution_options(synchronize_session=False))
+    res = await session.execute(stmt)
+    await session.commit()
+    return res.rowcount
+
+
+async def refresh_post_scores(session: AsyncSession, all_posts: bool = False) -> int | None:
+    """
+    Recomputes Post.score with the current weights, by default only for posts that /post/recommended can show.
+    Returns number of updated posts or None when another worker is already refreshing
+    """
+    if not await session.scalar(select(func.pg_try_advisory_xact_lock(func.hashtext('refresh_post_scores')))):
+        return None
+    score = post_score(Post.like_count, Post.comment_count, Post.created_time)
+    # counter shifts leave rounding noise, rewriting rows for it would touch every post on each run
+    stmt = (update(Post).where(func.abs(Post.score - score) > 1e-6)
+            .values(score=score, modified_time=Post.modified_time)
+            .execution_options(synchronize_session=False))
+    if not all_posts:
+        stmt = stmt.where(Post.created_time >= text("NOW() - INTERVAL '7 DAY'"))
+    res = await session.execute(stmt)
+    await session.commit()
+    if res.rowcount:
+        await feed_cache.invalidate()
+    return res.rowcount
+
+
 # likes
 async def set_like(session: AsyncSession, user_id: int, post_id: int):
-    insert_stmt = insert(Like).values(user_id=user_id, post_id=post_id).on_conflict_do_nothing()
-    await session.execute(insert_stmt)
+    insert_stmt = insert(Like).values(user_id=user_id, post_id=post_id).on_conflict_do_nothing().returning(Like.id)
+    inserted = await session.scalar(insert_stmt) is not None
+    if inserted:
+        await shift_post_counters(session, post_id, likes=1)
     await session.commit()
+    if inserted:
+        await feed_cache.invalidate()
 
 
 async def delete_like(session: AsyncSession, user_id: int, post_id: int):
-    stmt = delete(Like).where(Like.user_id == user_id, Like.post_id == post_id)
-    await session.execute(stmt)
+    stmt = delete(Like).where(Like.user_id == user_id, Like.post_id == post_id).returning(Like.id)
+    deleted = await session.scalar(stmt) is not None
+    if deleted:
+        await shift_post_counters(session, post_id, likes=-1)
     await session.commit()
+    if deleted:
+        await feed_cache.invalidate()
+
+
+async def apply_likes(session: AsyncSession, likes: dict[tuple[int, int], bool]) -> tuple[int, int]:
+    """
+    Writes a batch of (user_id, post_id) -> liked as one INSERT ... SELECT ... ON CONFLICT and one DELETE ... USING,
+    then shifts the counters of touched posts. Likes of missing or deleted posts are skipped, so one of them can't
+    fail the whole batch. Returns numbers of inserted and deleted likes
+    """
+    liked = [(user_id, post_id) for (user_id, post_id), state in likes.items() if state]
+    unliked = [(user_id, post_id) for (user_id, post_id), state in likes.items() if not state]
+    deltas = Counter()
+    inserted = deleted = 0
+    if liked:
+        pairs = values(column('user_id', Integer), column('post_id', Integer), name='liked').data(liked)
+        live = (select(pairs.c.user_id, pairs.c.post_id)
+                .join(Post, and_(Post.id == pairs.c.post_id, Post.is_deleted == 0))
+                .order_by(pairs.c.post_id, pairs.c.user_id))
+        stmt = (insert(Like).from_select(['user_id', 'post_id'], live)
+                .on_conflict_do_nothing().returning(Like.post_id))
+        for post_id in await session.scalars(stmt):
+            deltas[post_id] += 1
+            inserted += 1
+    if unliked:
+        pairs = values(column('user_id', Integer), column('post_id', Integer), name='unliked').data(unliked)
+        stmt = (delete(Like).where(Like.user_id == pairs.c.user_id, Like.post_id == pairs.c.post_id)
+                .returning(Like.post_id).execution_options(synchronize_session=False))
+        for post_id in await session.scalars(stmt):
+            deltas[post_id] -= 1
+            deleted += 1
+    deltas = sorted((post_id, delta) for post_id, delta in deltas.items() if delta)
+    if deltas:
+        # rows are locked in id order, so flushes of two workers wait for each other instead of deadlocking
+        await session.execute(select(Post.id).where(Post.id.in_([post_id for post_id, _ in deltas]))
+                              .order_by(Post.id).with_for_update(key_share=True))
+        shifts = values(column('id', Integer), column('delta', Integer), name='shifts').data(deltas)
+        stmt = (update(Post).where(Post.id == shifts.c.id)
+                .values(like_count=Post.like_count + shifts.c.delta,
+                        score=Post.score + config.POST_SCORE_C * shifts.c.delta,
+                        modified_time=Post.modified_time)
+                .execution_options(synchronize_session=False))
+        await session.execute(stmt)
+    await session.commit()
+    if inserted or deleted:
+        await feed_cache.invalidate()
+    return inserted, deleted
 
 
 async def get_count_likes(session: AsyncSession, post_id: int):
@@ -155,10 +654,13 @@ async def get_count_likes(session: AsyncSession, post_id: int):
 
 
 # comments:
-async def get_comments(session: AsyncSession, post_id, limit, offset):
+async def get_comments(session: AsyncSession, post_id, limit, offset, after=None,
+                       count_mode: CountMode = CountMode.exact):
     stmt = select(Comment).where(Comment.post_id == post_id, Comment.is_deleted == 0).options(
         selectinload(Comment.user))
-    res = await paginate(session, stmt, limit, offset)
+    res = await paginate_keyset(session, stmt, limit, offset, after, Comment.created_time, Comment.id,
+                                descending=False, count_mode=count_mode,
+                                estimate=select(Post.comment_count).where(Post.id == post_id))
     return res
 
 
@@ -176,7 +678,9 @@ async def add_comment(session: AsyncSession, user_id: int, post_id: int, text: s
         text=text
     )
     session.add(comment)
+    await shift_post_counters(session, post_id, comments=1)
     await session.commit()
+    await feed_cache.invalidate()
     return comment
 
 
@@ -189,11 +693,109 @@ async def update_comment(session: AsyncSession, comment_id: int, text: str | Non
 
 
 async def delete_comment(session: AsyncSession, comment_id: int):
-    await session.execute(delete(Comment).where(Comment.id == comment_id))
+    stmt = delete(Comment).where(Comment.id == comment_id).returning(Comment.post_id, Comment.is_deleted)
+    deleted = (await session.execute(stmt)).first()
+    if deleted is not None and deleted.is_deleted == 0:
+        await shift_post_counters(session, deleted.post_id, comments=-1)
     await session.commit()
+    await feed_cache.invalidate()
 
 
 async def get_comment_by_id(session: AsyncSession, id: int):
     stmt = select(Comment).where(Comment.id == id)
     comment = await session.scalar(stmt)
     return comment
+
+
+async def add_job(session: AsyncSession, queue: str, payload: dict, max_attempts: int, delay: float = 0) -> int:
+    run_at = func.now() + datetime.timedelta(seconds=delay) if delay else func.now()
+    id = await session.scalar(insert(Job).values(queue=queue, payload=payload, max_attempts=max_attempts,
+                                                 run_at=run_at).returning(Job.id))
+    await session.commit()
+    return id
+
+
+async def claim_jobs(session: AsyncSession, queue: str, limit: int, lease_seconds: float) -> list:
+    """
+    Takes up to limit due jobs of the queue for lease_seconds, skipping those other workers are taking.
+    Returns rows of id, payload, attempts (this one included), max_attempts and lag, seconds since it was due
+    """
+    due = (select(Job.id, Job.run_at)
+           .where(Job.queue == queue, Job.status.in_(('queued', 'running')), Job.run_at <= func.now(),
+                  Job.attempts < Job.max_attempts)
+           .order_by(Job.run_at, Job.id).limit(limit).with_for_update(skip_locked=True).cte('due'))
+    stmt = (update(Job).where(Job.id == due.c.id)
+            .values(status='running', attempts=Job.attempts + 1,
+                    run_at=func.now() + datetime.timedelta(seconds=lease_seconds))
+            .returning(Job.id, Job.payload, Job.attempts, Job.max_attempts,
+                       cast(func.extract('epoch', func.now() - due.c.run_at), Double).label('lag'))
+            .execution_options(synchronize_session=False))
+    jobs = (await session.execute(stmt)).all()
+    await session.commit()
+    return jobs
+
+
+async def fail_expired_jobs(session: AsyncSession, queue: str) -> int:
+    """
+    Fails the jobs of the queue whose worker was lost on the last attempt, claim_jobs doesn't take them again.
+    Returns their number
+    """
+    expired = (select(Job.id)
+               .where(Job.queue == queue, Job.status == 'running', Job.run_at <= func.now(),
+                      Job.attempts >= Job.max_attempts)
+               .with_for_update(skip_locked=True))
+    stmt = (update(Job).where(Job.id.in_(expired))
+            .values(status='failed', last_error="Lease expired on the last attempt")
+            .execution_options(synchronize_session=False))
+    count = (await session.execute(stmt)).rowcount
+    await session.commit()
+    return count
+
+
+def claimed(id: int, attempts: int) -> ColumnElement[bool]:
+    # the run of a job is still the one claimed with these attempts, not one taken again after its lease ended
+    return and_(Job.id == id, Job.status == 'running', Job.attempts == attempts)
+
+
+async def extend_job_lease(session: AsyncSession, id: int, attempts: int, lease_seconds: float) -> bool:
+    """
+    Moves the end of the lease of a running job lease_seconds from now, False if the run lost its lease
+    """
+    stmt = (update(Job).where(claimed(id, attempts))
+            .values(run_at=func.now() + datetime.timedelta(seconds=lease_seconds))
+            .execution_options(synchronize_session=False))
+    count = (await session.execute(stmt)).rowcount
+    await session.commit()
+    return count > 0
+
+
+async def finish_job(session: AsyncSession, id: int, attempts: int) -> bool:
+    """
+    Deletes a done job, this and retry_job and fail_job return False and change nothing if the run lost its lease
+    """
+    count = (await session.execute(delete(Job).where(claimed(id, attempts))
+                                   .execution_options(synchronize_session=False))).rowcount
+    await session.commit()
+    return count > 0
+
+
+async def retry_job(session: AsyncSession, id: int, attempts: int, delay: float, error: str | None,
+                    attempt: bool = True) -> bool:
+    """
+    Queues the job again after delay seconds, attempt=False doesn't count the interrupted run as an attempt
+    """
+    values = {'status': 'queued', 'run_at': func.now() + datetime.timedelta(seconds=delay), 'last_error': error}
+    if not attempt:
+        values['attempts'] = Job.attempts - 1
+    count = (await session.execute(update(Job).where(claimed(id, attempts)).values(**values)
+                                   .execution_options(synchronize_session=False))).rowcount
+    await session.commit()
+    return count > 0
+
+
+async def fail_job(session: AsyncSession, id: int, attempts: int, error: str) -> bool:
+    count = (await session.execute(update(Job).where(claimed(id, attempts))
+                                   .values(status='failed', last_error=error)
+                                   .execution_options(synchronize_session=False))).rowcount
+    await session.commit()
+    return count > 0
@@ -0,0 +1,17 @@
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+
+
+def alembic_config() -> Config:
+    cfg = Config()
+    cfg.set_main_option('script_location', str(Path(__file__).parent / 'migrations'))
+    return cfg
+
+
+def upgrade(revision: str = 'head'):
+    """
+    Brings the database to revision. Runs its own event loop, call it from a thread when one is running
+    """
+    command.upgrade(alembic_config(), revision)
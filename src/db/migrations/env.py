@@ -0,0 +1,53 @@
+import asyncio
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import pool, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src import config as app_config
+from src.db.schemas import Base
+
+if context.config.config_file_name is not None:
+    fileConfig(context.config.config_file_name)
+
+target_metadata = Base.metadata
+# any constant shared by everything migrating this database, pg_advisory_lock takes a bigint
+MIGRATION_LOCK = 0x50C1A1
+
+
+def run_migrations_offline():
+    context.configure(url=app_config.DB_URL, target_metadata=target_metadata, literal_binds=True,
+                      dialect_opts={"paramstyle": "named"}, transaction_per_migration=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection):
+    # every migration in its own transaction, so the ones building indexes concurrently can leave it
+    context.configure(connection=connection, target_metadata=target_metadata, transaction_per_migration=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_migrations_online():
+    engine = create_async_engine(app_config.DB_URL, poolclass=pool.NullPool)
+    # containers started together migrate one after another, the later ones find the database at head. The lock
+    # is polled rather than waited for: CREATE INDEX CONCURRENTLY waits for every running statement, a waiting
+    # pg_advisory_lock included, which would never end while the lock is held
+    async with engine.connect() as lock:
+        await lock.execution_options(isolation_level='AUTOCOMMIT')
+        while not await lock.scalar(text('SELECT pg_try_advisory_lock(:key)'), {'key': MIGRATION_LOCK}):
+            await asyncio.sleep(1)
+        try:
+            async with engine.connect() as connection:
+                await connection.run_sync(do_run_migrations)
+        finally:
+            await lock.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK})
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    asyncio.run(run_migrations_online())
@@ -0,0 +1,76 @@
+"""baseline: schema created by Base.metadata.create_all before migrations
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def timestamps():
+    return [sa.Column('created_time', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+            sa.Column('modified_time', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+            sa.Column('is_deleted', sa.Integer(), server_default=sa.text('0'), nullable=False)]
+
+
+def upgrade():
+    # databases made by create_all at startup already have these tables, the next migrations catch them up
+    if sa.inspect(op.get_bind()).has_table('user'):
+        return
+    op.create_table(
+        'user',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('login', sa.String(256), nullable=False, unique=True),
+        sa.Column('password', sa.String(), nullable=False),
+        sa.Column('name', sa.String(256), nullable=False),
+        sa.Column('about', sa.String()),
+        *timestamps())
+    op.create_table(
+        'image',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('hash', sa.String(), nullable=False),
+        sa.Column('width', sa.Integer(), nullable=False),
+        sa.Column('height', sa.Integer(), nullable=False),
+        sa.Column('created_by', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        *timestamps())
+    op.create_table(
+        'post',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('title', sa.String(256)),
+        sa.Column('text', sa.String()),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        *timestamps())
+    op.create_table(
+        'like',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('post_id', sa.Integer(), sa.ForeignKey('post.id'), nullable=False),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('created_time', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+        sa.UniqueConstraint('post_id', 'user_id', name='u_like'))
+    op.create_index('idx_like', 'like', ['post_id', 'user_id'], unique=True)
+    op.create_table(
+        'comment',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('text', sa.String(4096), nullable=False),
+        sa.Column('post_id', sa.Integer(), sa.ForeignKey('post.id'), nullable=False),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), nullable=False),
+        *timestamps())
+    op.create_table(
+        'user_image',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('image_id', sa.Integer(), sa.ForeignKey('image.id'), primary_key=True))
+    op.create_table(
+        'post_image',
+        sa.Column('post_id', sa.Integer(), sa.ForeignKey('post.id'), primary_key=True),
+        sa.Column('image_id', sa.Integer(), sa.ForeignKey('image.id'), primary_key=True))
+
+
+def downgrade():
+    for table in ('post_image', 'user_image', 'comment', 'like', 'post', 'image', 'user'):
+        op.drop_table(table)
@@ -0,0 +1,49 @@
+"""post counters and score, content addressed images with variants and reference counts
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src import config
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # IF NOT EXISTS everywhere: create_all of a newer version may have added some of these already
+    op.execute('ALTER TABLE post ADD COLUMN IF NOT EXISTS like_count INTEGER DEFAULT 0 NOT NULL, '
+               'ADD COLUMN IF NOT EXISTS comment_count INTEGER DEFAULT 0 NOT NULL, '
+               'ADD COLUMN IF NOT EXISTS score DOUBLE PRECISION DEFAULT 0 NOT NULL')
+    op.execute('ALTER TABLE image ADD COLUMN IF NOT EXISTS variant_widths INTEGER[], '
+               'ADD COLUMN IF NOT EXISTS ref_count INTEGER DEFAULT 0 NOT NULL')
+    if 'image_hash_key' not in {c['name'] for c in sa.inspect(op.get_bind()).get_unique_constraints('image')}:
+        op.create_unique_constraint('image_hash_key', 'image', ['hash'])
+
+    # same as repair_post_counters, repair_image_refs and refresh_post_scores(all_posts=True)
+    op.execute('''
+        UPDATE post SET like_count = (SELECT count(*) FROM "like" WHERE "like".post_id = post.id),
+                        comment_count = (SELECT count(*) FROM comment
+                                         WHERE comment.post_id = post.id AND comment.is_deleted = 0),
+                        modified_time = post.modified_time
+    ''')
+    op.execute(sa.text('''
+        UPDATE post SET score = :c * like_count + :x * comment_count + :f * extract(epoch FROM created_time),
+                        modified_time = post.modified_time
+    ''').bindparams(c=config.POST_SCORE_C, x=config.POST_SCORE_X, f=config.POST_SCORE_F))
+    op.execute('''
+        UPDATE image SET ref_count = (SELECT count(*) FROM post_image WHERE post_image.image_id = image.id)
+                                     + (SELECT count(*) FROM user_image WHERE user_image.image_id = image.id),
+                         modified_time = image.modified_time
+    ''')
+
+
+def downgrade():
+    op.drop_constraint('image_hash_key', 'image')
+    op.execute('ALTER TABLE image DROP COLUMN variant_widths, DROP COLUMN ref_count')
+    op.execute('ALTER TABLE post DROP COLUMN like_count, DROP COLUMN comment_count, DROP COLUMN score')
@@ -0,0 +1,53 @@
+"""indexes of the listing queries, built concurrently
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+
+Each listing filters is_deleted = 0 and orders by its keyset, so every index is partial on live rows and ends
+with the columns of the ORDER BY:
+    get_posts             WHERE is_deleted = 0 ORDER BY created_time, id
+    get_posts_user_id     WHERE is_deleted = 0 AND user_id = ? ORDER BY created_time, id
+    get_most_liked_posts  WHERE is_deleted = 0 AND created_time >= now() - 7 days ORDER BY score, id
+    get_comments          WHERE is_deleted = 0 AND post_id = ? ORDER BY created_time, id
+    get_liked_post_ids    WHERE user_id = ? AND post_id IN (...)
+idx_like duplicated the u_like constraint and idx_post_score lacked the id tie breaker, both are dropped.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+LIVE = sa.text('is_deleted = 0')
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY doesn't lock writes but can't run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('idx_post_created', 'post', ['created_time', 'id'], postgresql_where=LIVE,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('idx_post_user_created', 'post', ['user_id', 'created_time', 'id'], postgresql_where=LIVE,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('idx_post_score_id', 'post', ['score', 'id'], postgresql_where=LIVE,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('idx_comment_post_created', 'comment', ['post_id', 'created_time', 'id'],
+                        postgresql_where=LIVE, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('idx_like_user', 'like', ['user_id', 'post_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('idx_post_score', 'post', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('idx_like', 'like', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('idx_like', 'like', ['post_id', 'user_id'], unique=True, postgresql_concurrently=True,
+                        if_not_exists=True)
+        op.create_index('idx_post_score', 'post', ['score'], postgresql_where=LIVE, postgresql_concurrently=True,
+                        if_not_exists=True)
+        for table, index in (('like', 'idx_like_user'), ('comment', 'idx_comment_post_created'),
+                             ('post', 'idx_post_score_id'), ('post', 'idx_post_user_created'),
+                             ('post', 'idx_post_created')):
+            op.drop_index(index, table, postgresql_concurrently=True, if_exists=True)
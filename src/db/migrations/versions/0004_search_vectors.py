@@ -0,0 +1,42 @@
+"""full-text search vectors of posts and comments
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+
+The vectors are stored generated columns, so Postgres keeps them right on every insert and update. Adding one
+rewrites its table under an exclusive lock, on a big table run this migration in a quiet window.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+LIVE = sa.text('is_deleted = 0')
+# SEARCH_CONFIG of src.db.schemas at the time of this revision
+SEARCH_CONFIG = 'russian'
+
+
+def upgrade():
+    op.add_column('post', sa.Column('search_vector', TSVECTOR(), sa.Computed(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(text, '')), 'B')", persisted=True)))
+    op.add_column('comment', sa.Column('search_vector', TSVECTOR(), sa.Computed(
+        f"to_tsvector('{SEARCH_CONFIG}', text)", persisted=True)))
+    with op.get_context().autocommit_block():
+        op.create_index('idx_post_search', 'post', ['search_vector'], postgresql_using='gin',
+                        postgresql_where=LIVE, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('idx_comment_search', 'comment', ['search_vector'], postgresql_using='gin',
+                        postgresql_where=LIVE, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_comment_search', 'comment', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('idx_post_search', 'post', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('comment', 'search_vector')
+    op.drop_column('post', 'search_vector')
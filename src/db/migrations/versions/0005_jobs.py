@@ -0,0 +1,36 @@
+"""job table of the background job queue
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'job',
+        sa.Column('id', sa.BigInteger(), primary_key=True),
+        sa.Column('queue', sa.String(64), nullable=False),
+        sa.Column('payload', JSONB(), nullable=False),
+        sa.Column('status', sa.String(16), server_default=sa.text("'queued'"), nullable=False),
+        sa.Column('run_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+        sa.Column('attempts', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('created_time', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+        sa.Column('modified_time', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    )
+    op.create_index('idx_job_queue_run_at', 'job', ['queue', 'run_at', 'id'],
+                    postgresql_where=sa.text("status IN ('queued', 'running')"))
+
+
+def downgrade():
+    op.drop_table('job')
@@ -0,0 +1,38 @@
+"""orphaned_time of images and the indexes of gc-images
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+
+Images unreferenced at the time of this migration count as orphaned from now on, so none of them is collected
+before a full grace period has passed.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('image', sa.Column('orphaned_time', sa.DateTime(), server_default=sa.text('now()'),
+                                     nullable=True))
+    op.execute('UPDATE image SET orphaned_time = NULL, modified_time = image.modified_time WHERE ref_count > 0')
+    with op.get_context().autocommit_block():
+        op.create_index('idx_post_image_image', 'post_image', ['image_id'], postgresql_concurrently=True,
+                        if_not_exists=True)
+        op.create_index('idx_user_image_image', 'user_image', ['image_id'], postgresql_concurrently=True,
+                        if_not_exists=True)
+        op.create_index('idx_image_orphaned', 'image', ['orphaned_time', 'id'],
+                        postgresql_where=sa.text('is_deleted = 0 AND ref_count = 0'),
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, index in (('image', 'idx_image_orphaned'), ('user_image', 'idx_user_image_image'),
+                             ('post_image', 'idx_post_image_image')):
+            op.drop_index(index, table, postgresql_concurrently=True, if_exists=True)
+    op.drop_column('image', 'orphaned_time')
@@ -1,7 +1,9 @@
 import datetime
 from typing import Annotated
 
-from sqlalchemy import String, text, ForeignKey, Table, Column, UniqueConstraint, Index
+from sqlalchemy import String, text, ForeignKey, Table, Column, UniqueConstraint, Index, Integer, Computed, \
+    BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR, JSONB
 from sqlalchemy.orm import DeclarativeBase, query_expression
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -14,6 +16,9 @@ is_deleted = Annotated[int, mapped_column(
     server_default=text("0")
 )]
 
+# text search configuration of the search_vector columns and of the queries against them
+SEARCH_CONFIG = 'russian'
+
 
 class Base(DeclarativeBase):
     pass
@@ -24,6 +29,8 @@ image_user_table = Table(
     Base.metadata,
     Column("user_id", ForeignKey("user.id"), primary_key=True),
     Column("image_id", ForeignKey("image.id"), primary_key=True),
+    # for the anti-join of orphaned images, the primary key starts with user_id
+    Index("idx_user_image_image", "image_id"),
 )
 
 
@@ -58,11 +65,18 @@ image_post_table = Table(
     Base.metadata,
     Column("post_id", ForeignKey("post.id"), primary_key=True),
     Column("image_id", ForeignKey("image.id"), primary_key=True),
+    Index("idx_post_image_image", "image_id"),
 )
 
 
 class Post(Base):
     __tablename__ = "post"
+    # one per listing: /post/latests, /post/user/{id} and /post/recommended, see the 0003 migration
+    __table_args__ = (
+        Index("idx_post_created", "created_time", "id", postgresql_where=text("is_deleted = 0")),
+        Index("idx_post_user_created", "user_id", "created_time", "id", postgresql_where=text("is_deleted = 0")),
+        Index("idx_post_score_id", "score", "id", postgresql_where=text("is_deleted = 0")),
+        Index("idx_post_search", "search_vector", postgresql_using="gin", postgresql_where=text("is_deleted = 0")))
 
     id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str | None] = mapped_column(String(256))
@@ -75,11 +89,18 @@ class Post(Base):
     images: Mapped[list["Image"]] = relationship(secondary=image_post_table, lazy='selectin')
     like: Mapped[list["Like"]] = relationship(
         back_populates="post")
-    like_count: Mapped[int] = query_expression()
+    like_count: Mapped[int] = mapped_column(server_default=text("0"))
     is_liked: Mapped[bool] = query_expression()
     comment: Mapped[list["Comment"]] = relationship(
         back_populates="post")
-    comment_count: Mapped[int] = query_expression()
+    comment_count: Mapped[int] = mapped_column(server_default=text("0"))
+    # C * like_count + X * comment_count + F * created_time as epoch, see src.db.utils.post_score
+    score: Mapped[float] = mapped_column(server_default=text("0"))
+    # kept by Postgres on every write, a title match outranks a text match. Deferred, only search reads it
+    search_vector: Mapped[str | None] = mapped_column(TSVECTOR, Computed(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(text, '')), 'B')", persisted=True), deferred=True)
+    search_rank: Mapped[float] = query_expression()
 
     def __repr__(self) -> str:
         return str(self)
@@ -90,14 +111,26 @@ class Post(Base):
 
 class Image(Base):
     __tablename__ = "image"
+    # images src.manage gc-images may delete, oldest orphans first
+    __table_args__ = (
+        Index("idx_image_orphaned", "orphaned_time", "id",
+              postgresql_where=text("is_deleted = 0 AND ref_count = 0")),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    hash: Mapped[str] = mapped_column(nullable=False)
+    # storage key, sha256 of the content plus extension
+    hash: Mapped[str] = mapped_column(nullable=False, unique=True)
     width: Mapped[int] = mapped_column(nullable=False)
     height: Mapped[int] = mapped_column(nullable=False)
+    # widths of the WebP variants in storage, NULL until they are generated
+    variant_widths: Mapped[list[int] | None] = mapped_column(ARRAY(Integer))
+    # rows in post_image and user_image, the object may only be deleted at 0
+    ref_count: Mapped[int] = mapped_column(server_default=text("0"))
+    # since when ref_count is 0, NULL while the image is referenced
+    orphaned_time: Mapped[datetime.datetime | None] = mapped_column(server_default=text("now()"))
     created_by: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=False)
     created_time: Mapped[created]
     modified_time: Mapped[modified]
+    # 2 while gc-images deletes the objects, then 1
     is_deleted: Mapped[is_deleted]
 
     def __repr__(self) -> str:
@@ -110,7 +143,7 @@ class Image(Base):
 class Like(Base):
     __tablename__ = "like"
     __table_args__ = (
-        Index("idx_like", "post_id", "user_id", unique=True),
+        Index("idx_like_user", "user_id", "post_id"),
         UniqueConstraint("post_id", "user_id", name="u_like"))
 
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -129,6 +162,9 @@ class Like(Base):
 
 class Comment(Base):
     __tablename__ = "comment"
+    __table_args__ = (
+        Index("idx_comment_post_created", "post_id", "created_time", "id", postgresql_where=text("is_deleted = 0")),
+        Index("idx_comment_search", "search_vector", postgresql_using="gin", postgresql_where=text("is_deleted = 0")))
 
     id: Mapped[int] = mapped_column(primary_key=True)
     text: Mapped[str] = mapped_column(String(4096), nullable=False)
@@ -139,6 +175,8 @@ class Comment(Base):
     created_time: Mapped[created]
     modified_time: Mapped[modified]
     is_deleted: Mapped[is_deleted]
+    search_vector: Mapped[str | None] = mapped_column(TSVECTOR, Computed(f"to_tsvector('{SEARCH_CONFIG}', text)",
+                                                                  persisted=True), deferred=True)
 
     def __repr__(self) -> str:
         return str(self)
@@ -147,31 +185,31 @@ class Comment(Base):
         return f"Comment(id={self.id!r}, user_id={self.user_id!r}, post_id={self.post_id!r}, text={self.text!r})"
 
 
+class Job(Base):
+    """
+    Deferred work for the handlers of src.api.jobs. Done jobs are deleted, failed ones stay for inspection
+    """
+    __tablename__ = "job"
+    # the claimable jobs of a queue, oldest due first
+    __table_args__ = (
+        Index("idx_job_queue_run_at", "queue", "run_at", "id",
+              postgresql_where=text("status IN ('queued', 'running')")),)
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    queue: Mapped[str] = mapped_column(String(64), nullable=False)
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    # queued, running or failed. A running job whose run_at passed lost its worker and is taken again
+    status: Mapped[str] = mapped_column(String(16), server_default=text("'queued'"))
+    # when a queued job is due, when the lease of a running one ends
+    run_at: Mapped[datetime.datetime] = mapped_column(server_default=text("now()"))
+    attempts: Mapped[int] = mapped_column(server_default=text("0"))
+    max_attempts: Mapped[int] = mapped_column(nullable=False)
+    last_error: Mapped[str | None]
+    created_time: Mapped[created]
+    modified_time: Mapped[modified]
 
-async def create_reccomended_func(session):
-    await session.execute(text("""CREATE OR REPLACE FUNCTION calculate_post_score(p_id INT, C float, X float, F float)
-RETURNS INT AS $$
-DECLARE
-    like_count INT;
-    comment_count INT;
-    time_passed INTERVAL;
-BEGIN
-    SELECT COUNT(*)
-    INTO like_count
-    FROM "like"
-    WHERE "post_id" = p_id;
-
-    SELECT COUNT(*)
-    INTO comment_count
-    FROM "comment"
-    WHERE "post_id" = p_id;
-
-    SELECT NOW() - "created_time"
-    INTO time_passed
-    FROM "post"
-    WHERE "id" = p_id;
-
-    RETURN C * like_count + X * comment_count - F * EXTRACT(EPOCH FROM time_passed);
-END;
-$$ LANGUAGE plpgsql;"""))
-    await session.commit()
\ No newline at end of file
+    def __repr__(self) -> str:
+        return str(self)
+
+    def __str__(self):
+        return f"Job(id={self.id!r}, queue={self.queue!r}, status={self.status!r}, attempts={self.attempts!r})"
@@ -1,12 +1,100 @@
-from sqlalchemy import func, distinct, case
+import base64
+import datetime
+import json
+from enum import Enum
+
+from sqlalchemy import exists, func, ColumnElement
 from sqlalchemy.orm import selectinload, with_expression
 
-from src.db.schemas import User, Post, Like, Comment
+from src import config
+from src.db.schemas import User, Post, Like, Image
+
+
+class CountMode(str, Enum):
+    """
+    How a paginated response fills its count: exactly, by the planner's or a counter's estimate, or not at all
+    """
+    exact = 'exact'
+    estimated = 'estimated'
+    none = 'none'
+
+
+def post_options(user_id: int | None):
+    options = [selectinload(Post.user).selectinload(User.images),
+               selectinload(Post.images)]
+    if user_id is not None:
+        options.append(with_expression(Post.is_liked,
+                                       exists().where(Like.post_id == Post.id, Like.user_id == user_id)))
+    return options
+
+
+def image_to_dict(image: Image) -> dict:
+    return {'hash': image.hash, 'width': image.width, 'height': image.height, 'variant_widths': image.variant_widths}
+
+
+def user_to_dict(user: User) -> dict:
+    return {'id': user.id, 'name': user.name, 'about': user.about,
+            'images': [image_to_dict(image) for image in user.images]}
+
+
+def post_to_dict(post: Post) -> dict:
+    """
+    Plain form of a post with the fields of PostResponse except is_liked, which depends on the reader
+    """
+    return {
+        'id': post.id,
+        'title': post.title,
+        'text': post.text,
+        'images': [image_to_dict(image) for image in post.images],
+        'user': user_to_dict(post.user),
+        'like_count': post.like_count,
+        'comment_count': post.comment_count,
+    }
+
+
+def post_score(like_count, comment_count, created_time) -> ColumnElement:
+    """
+    Trending score of a post. The time penalty -F * (now - created_time) is shifted by F * now, which is
+    the same for every post at a given moment, so the order is unchanged while the stored value never goes stale
+    """
+    return (config.POST_SCORE_C * like_count + config.POST_SCORE_X * comment_count
+            + config.POST_SCORE_F * func.extract('epoch', created_time))
+
+
+def _encode_key(key: list) -> str:
+    raw = json.dumps(key, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode_key(cursor: str) -> list:
+    return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+
+
+def encode_cursor(created_time: datetime.datetime, id: int) -> str:
+    return _encode_key([created_time.isoformat(), id])
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    """
+    Inverse of encode_cursor, raises ValueError on anything a client could have tampered with
+    """
+    try:
+        created_time, id = _decode_key(cursor)
+        return datetime.datetime.fromisoformat(created_time), int(id)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def encode_search_cursor(rank: float, id: int) -> str:
+    return _encode_key([rank, id])
 
 
-def post_options(user_id: int):
-    return [selectinload(Post.user).selectinload(User.images),
-            selectinload(Post.images),
-            with_expression(Post.like_count, func.count(distinct(Like.id))),
-            with_expression(Post.comment_count, func.count(distinct(Comment.id))),
-            with_expression(Post.is_liked, func.sum(distinct(case((Like.user_id == user_id, 1), else_=0))))]
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    """
+    Inverse of encode_search_cursor, raises ValueError like decode_cursor
+    """
+    try:
+        rank, id = _decode_key(cursor)
+        return float(rank), int(id)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
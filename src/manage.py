@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import signal
+
+from sqlalchemy import event, func, select, text
+
+from src.api.sessions import async_session, s3_client, engine
+from src.db import crud
+from src.db.schemas import Post, Comment
+from src.db.utils import CountMode, decode_cursor
+
+
+async def migrate(args):
+    from src.db.migrate import upgrade
+
+    await asyncio.to_thread(upgrade, args.revision)
+    print(f"Migrated to {args.revision}")
+
+
+async def repair_counters(args):
+    async with async_session() as session:
+        fixed = await crud.repair_post_counters(session)
+        print(f"Fixed counters of {fixed} posts")
+        fixed = await crud.repair_image_refs(session)
+        print(f"Fixed reference counts of {fixed} images")
+
+
+async def refresh_scores(args):
+    async with async_session() as session:
+        updated = await crud.refresh_post_scores(session, all_posts=args.all)
+    if updated is None:
+        print("Scores are being refreshed by another process")
+    else:
+        print(f"Refreshed score of {updated} posts")
+
+
+async def backfill_variants(args):
+    from src.api.routers.images.utils import generate_variants
+
+    processed, after_id = 0, 0
+    await s3_client.start()
+    try:
+        while True:
+            async with async_session() as session:
+                images = await crud.get_images_without_variants(session, args.batch, after_id)
+            if not images:
+                break
+            results = await asyncio.gather(*(generate_variants(image.hash) for image in images),
+                                           return_exceptions=True)
+            for image, result in zip(images, results):
+                if isinstance(result, Exception):
+                    print(f"Failed to process {image.hash}: {result!r}")
+            processed += len(images)
+            after_id = images[-1].id
+            print(f"Processed {processed} images")
+    finally:
+        await s3_client.stop()
+
+
+async def gc_images(args):
+    from src.api.routers.images.utils import collect_orphaned_images
+
+    await s3_client.start()
+    try:
+        result = await collect_orphaned_images(args.grace_hours * 3600, args.batch, dry_run=args.dry_run)
+    finally:
+        await s3_client.stop()
+    if result is None:
+        raise SystemExit("Images are being collected by another process")
+    print(json.dumps(result))
+
+
+async def worker(args):
+    """
+    Works on background jobs until SIGTERM or SIGINT, the jobs in progress go back to their queues
+    """
+    from prometheus_client import start_http_server
+    from src.api.jobs import jobs
+    from src.api.routers import auth, users, posts, images  # noqa: F401, the routers register job handlers
+
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+    await s3_client.start()
+    task = asyncio.create_task(jobs.run(args.queues.split(',') if args.queues else None))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await s3_client.stop()
+
+
+def seq_scans(plan: dict) -> list[str]:
+    scans = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for child in plan.get('Plans', []):
+        scans += seq_scans(child)
+    return scans
+
+
+async def check_plans(args):
+    """
+    Runs the listing queries on the current data, EXPLAINs every statement they sent and fails when one
+    scans a table of more than --min-rows rows sequentially. Meant for a database filled by bench.seed
+    """
+    statements = []
+    label = None
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((label, statement, parameters))
+
+    async with async_session() as session:
+        post_id = await session.scalar(select(Post.id).where(Post.is_deleted == 0)
+                                       .order_by(Post.comment_count.desc()).limit(1))
+        user_id = await session.scalar(select(Post.user_id).where(Post.is_deleted == 0).group_by(Post.user_id)
+                                       .order_by(func.count().desc()).limit(1))
+        if post_id is None:
+            raise SystemExit("No posts to query, fill the database with python -m bench.seed first")
+
+        event.listen(engine.sync_engine, 'before_cursor_execute', capture)
+        try:
+            # past feed_cache, which would answer the first pages without any SQL
+            label = 'get_posts'
+            page = await crud._get_posts(session, args.limit, 0, user_id, None, CountMode.none)
+            if page['next_cursor']:
+                label = 'get_posts after cursor'
+                await crud._get_posts(session, args.limit, 0, user_id, decode_cursor(page['next_cursor']),
+                                      CountMode.none)
+            label = 'get_most_liked_posts'
+            await crud._get_most_liked_posts(session, args.limit, 0, user_id, CountMode.none)
+            label = 'get_most_liked_posts deep'
+            await crud._get_most_liked_posts(session, args.limit, args.limit * 100, user_id, CountMode.none)
+            label = 'get_posts_user_id'
+            page = await crud.get_posts_user_id(session, args.limit, 0, user_id, user_id,
+                                                count_mode=CountMode.none)
+            if page['next_cursor']:
+                label = 'get_posts_user_id after cursor'
+                await crud.get_posts_user_id(session, args.limit, 0, user_id, user_id,
+                                             after=decode_cursor(page['next_cursor']), count_mode=CountMode.none)
+            label = 'get_comments'
+            page = await crud.get_comments(session, post_id, args.limit, 0, count_mode=CountMode.none)
+            if page['next_cursor']:
+                label = 'get_comments after cursor'
+                await crud.get_comments(session, post_id, args.limit, 0, after=decode_cursor(page['next_cursor']),
+                                        count_mode=CountMode.none)
+        finally:
+            event.remove(engine.sync_engine, 'before_cursor_execute', capture)
+
+        conn = await session.connection()
+        rows = dict((await conn.execute(text("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'"))).all())
+        failed = False
+        for label, statement, parameters in statements:
+            result = await conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters)
+            plan = result.scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            scans = [table for table in seq_scans(plan[0]['Plan']) if rows.get(table, 0) > args.min_rows]
+            failed = failed or bool(scans)
+            print(f"{'SEQ SCAN ' + ', '.join(scans) if scans else 'ok'}: {label}: {' '.join(statement.split())[:120]}")
+    if failed:
+        raise SystemExit("Some queries scan tables sequentially")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m src.manage", description="Maintenance commands of the API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("repair-counters", help="recompute counters of posts and reference counts of images")
+    cmd.set_defaults(handler=repair_counters)
+
+    cmd = commands.add_parser("refresh-scores", help="recompute trending score of posts with current weights")
+    cmd.add_argument("--all", action="store_true", help="not only posts of the last 7 days")
+    cmd.set_defaults(handler=refresh_scores)
+
+    cmd = commands.add_parser("backfill-variants", help="generate resized variants of images uploaded before")
+    cmd.add_argument("--batch", type=int, default=20, help="images processed concurrently")
+    cmd.set_defaults(handler=backfill_variants)
+
+    cmd = commands.add_parser("gc-images", help="delete images unreferenced for the grace period from storage")
+    cmd.add_argument("--grace-hours", type=float, default=24, help="unreferenced for at least this long")
+    cmd.add_argument("--batch", type=int, default=500, help="images per batch, their objects in DeleteObjects "
+                                                            "requests of up to 1000 keys")
+    cmd.add_argument("--dry-run", action="store_true", help="only count what would be deleted")
+    cmd.set_defaults(handler=gc_images)
+
+    cmd = commands.add_parser("worker", help="run background jobs")
+    cmd.add_argument("--queues", help="comma separated, all by default")
+    cmd.add_argument("--metrics-port", type=int, help="serve Prometheus metrics of the worker on this port")
+    cmd.set_defaults(handler=worker)
+
+    cmd = commands.add_parser("migrate", help="apply schema migrations")
+    cmd.add_argument("revision", nargs="?", default="head")
+    cmd.set_defaults(handler=migrate)
+
+    cmd = commands.add_parser("check-plans", help="fail if listing queries scan big tables sequentially")
+    cmd.add_argument("--limit", type=int, default=20, help="page size of the queries")
+    cmd.add_argument("--min-rows", type=int, default=10000, help="smaller tables may be scanned")
+    cmd.set_defaults(handler=check_plans)
+
+    args = parser.parse_args()
+    asyncio.run(args.handler(args))
+
+
+if __name__ == '__main__':
+    main()